@@ -0,0 +1,145 @@
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+# Слоги для синтетических "русских" слов
+SYLLABLES = ['ва', 'ли', 'то', 'ст', 'за', 'дру', 'же', 'ско', 'ра', 'мо', 'не', 'пра', 'зд', 'ник', 'лю', 'бо', 'вь']
+
+
+def use_database(path: str = None) -> str:
+    """
+    Направляет бота на отдельный sqlite-файл. Вызывать до импорта utils и telegram_bot
+    """
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix='toastbot-bench-'), 'bench.db')
+    os.environ['DATABASE'] = f"sqlite:///{path}"
+    os.environ['ARTIFACTS_DIR'] = os.path.dirname(path)
+    os.environ.setdefault('TELEGRAM_API', '0:bench')
+    return path
+
+
+def make_word(rng: random.Random) -> str:
+    """
+    Синтетическое слово из 2-4 слогов
+    """
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def make_toast(rng: random.Random, vocabulary: List[str]) -> str:
+    """
+    Синтетический тост из 2-5 предложений
+    """
+    sentences = []
+    for _ in range(rng.randint(2, 5)):
+        words = [rng.choice(vocabulary) for _ in range(rng.randint(5, 12))]
+        sentences.append(' '.join(words).capitalize() + '.')
+    return ' '.join(sentences)
+
+
+def reset_database(engine: Any, base: Any) -> None:
+    """
+    Пересоздание всех таблиц
+    """
+    base.metadata.drop_all(engine)
+    base.metadata.create_all(engine)
+
+
+def fill_toasts(engine: Any, count: int, seed: int = 0) -> List[str]:
+    """
+    Вставка count синтетических тостов одной транзакцией. Возвращает словарь корпуса
+    """
+    from sqlalchemy import insert
+    from utils.models import Toast
+
+    rng = random.Random(seed)
+    vocabulary = list({make_word(rng) for _ in range(5000)})
+    with engine.begin() as connection:
+        for start in range(0, count, 50000):
+            connection.execute(insert(Toast), [{'toast_text': make_toast(rng, vocabulary)}
+                                               for _ in range(start, min(count, start + 50000))])
+    return vocabulary
+
+
+def fill_tagged_toasts(count: int, seed: int = 0, tags_per_toast: int = 10) -> List[str]:
+    """
+    Заливка count синтетических тостов с тегами так же, как при первом запуске (через BulkWriter).
+    Теги - случайные слова самого тоста, как 10 лучших слов по tf-idf. Возвращает словарь корпуса
+    """
+    from utils.bulk_writer import BulkWriter
+
+    rng = random.Random(seed)
+    vocabulary = list({make_word(rng) for _ in range(5000)})
+    with BulkWriter() as writer:
+        for _ in range(count):
+            text = make_toast(rng, vocabulary)
+            words = list(set(text.lower().replace('.', '').split()))
+            writer.add(text, rng.sample(words, min(tags_per_toast, len(words))))
+    return vocabulary
+
+
+def fill_users(engine: Any, users: int, toasts: int, history: int, vocabulary: List[str], seed: int = 0) -> None:
+    """
+    Синтетическая история users юзеров (chat_id от 1 до users): текущая стадия, введенные теги
+    и history присланных тостов - из базы (каждый десятый с дизлайком) и сгенерированных
+    """
+    import json
+    from sqlalchemy import insert
+    from core import USER_STAGES
+    from utils.generated_cache import toast_hash
+    from utils.models import GeneratedToast, Stages, ToastToUser, UserStage, UserTags
+
+    rng = random.Random(seed)
+    with engine.begin() as connection:
+        if not connection.execute(Stages.__table__.select().limit(1)).first():
+            connection.execute(insert(Stages), [{'stage_name': stage} for stage in USER_STAGES])
+
+        for start in range(1, users + 1, 10000):
+            chat_ids = range(start, min(users, start + 9999) + 1)
+            connection.execute(insert(UserStage), [{'chat_id': chat_id, 'stage_id': rng.randint(1, len(USER_STAGES))}
+                                                   for chat_id in chat_ids])
+            connection.execute(insert(UserTags), [{'chat_id': chat_id, 'user_tags': json.dumps(
+                rng.sample(vocabulary, 3), ensure_ascii=False)} for chat_id in chat_ids])
+
+            records, generated = [], {}
+            for chat_id in chat_ids:
+                for _ in range(history):
+                    if rng.random() < 0.7:
+                        records.append({'chat_id': chat_id, 'toast_id': rng.randint(1, toasts),
+                                        'generated_id': None, 'user_like': rng.random() >= 0.1})
+                    else:
+                        text = make_toast(rng, vocabulary)
+                        generated[toast_hash(text)] = text
+                        records.append({'chat_id': chat_id, 'toast_id': None,
+                                        'generated_id': toast_hash(text), 'user_like': False})
+            connection.execute(insert(ToastToUser), records)
+            if generated:
+                connection.execute(insert(GeneratedToast).prefix_with('OR IGNORE'),
+                                   [{'id': generated_id, 'toast_text': text} for generated_id, text in generated.items()])
+
+
+def timed(function: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """
+    Время вызовов function в миллисекундах: среднее и перцентили
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return summarize(times)
+
+
+def summarize(times: List[float]) -> Dict[str, float]:
+    """
+    Среднее и перцентили времен в миллисекундах
+    """
+    times = sorted(times)
+    return {
+        'mean_ms': round(statistics.mean(times), 4),
+        'p50_ms': round(times[len(times) // 2], 4),
+        'p95_ms': round(times[min(len(times) - 1, int(len(times) * 0.95))], 4),
+        'p99_ms': round(times[min(len(times) - 1, int(len(times) * 0.99))], 4),
+    }
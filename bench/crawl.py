@@ -0,0 +1,101 @@
+"""
+Офлайн-проверка и бенчмарк парсера сайтов: локальный HTTP-сервер отдает сохраненные страницы
+из bench/fixtures (при желании - с ошибками 503 на первые запросы), а PageParser их обходит
+
+    python -m bench.crawl --fail-first 2
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict
+
+FIXTURES_DIR = Path(__file__).parent / 'fixtures'
+
+
+class StubHandler(SimpleHTTPRequestHandler):
+    """
+    Отдает файлы из папки с фикстурами, подставляя адрес сервера вместо {{host}}
+    """
+    fail_first: int = 0
+    failures: Dict[str, int] = {}
+    lock: threading.Lock = threading.Lock()
+
+    def do_GET(self) -> None:
+        # Первые fail_first запросов к каждой странице падают, чтобы проверить повторы
+        with self.lock:
+            failed = self.failures.get(self.path, 0)
+            if failed < self.fail_first:
+                self.failures[self.path] = failed + 1
+        if failed < self.fail_first:
+            self.send_error(503)
+            return
+
+        path = Path(self.translate_path(self.path))
+        if path.is_dir():
+            path = path / 'index.html'
+        if not path.is_file():
+            self.send_error(404)
+            return
+
+        page = path.read_text(encoding='utf-8').replace('{{host}}', self.headers['Host']).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+def start_stub_server(fail_first: int = 0) -> ThreadingHTTPServer:
+    """
+    Запуск сервера с фикстурами на свободном порту в отдельном потоке
+    """
+    StubHandler.fail_first = fail_first
+    StubHandler.failures = {}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(StubHandler, directory=str(FIXTURES_DIR)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--fail-first', type=int, default=0, help='сколько первых запросов к странице отвечают 503')
+    args = parser.parse_args()
+
+    # Без пауз между запросами, чтобы проверка шла быстро
+    os.environ.setdefault('CRAWL_DELAY', '0')
+    os.environ.setdefault('CRAWL_BACKOFF', '0.01')
+    os.environ.setdefault('CRAWL_MAX_ATTEMPTS', str(args.fail_first + 1))
+    from utils.parse_schema import PageParser
+
+    server = start_stub_server(args.fail_first)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    with open(FIXTURES_DIR / 'expected.json', 'r', encoding='utf-8') as expected_file:
+        expected = json.load(expected_file)
+
+    ok = True
+    for site_name, site in expected.items():
+        page_parser = PageParser()
+        start = time.perf_counter()
+        page_parser.crawl_site(base_url + site['path'], site_name=site_name)
+        elapsed = time.perf_counter() - start
+
+        ok &= len(page_parser.toasts) == site['toasts']
+        print(json.dumps({'site': site_name, 'toasts': len(page_parser.toasts), 'expected': site['toasts'],
+                          'seconds': round(elapsed, 3)}, ensure_ascii=False))
+
+    server.shutdown()
+    if not ok:
+        raise SystemExit('Parsed toast counts differ from bench/fixtures/expected.json')
+
+
+if __name__ == '__main__':
+    main()
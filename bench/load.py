@@ -0,0 +1,281 @@
+"""
+Нагрузочный тест: симулированные юзеры ходят по меню бота, а апдейты идут через DispatchBot
+и обработчики из telegram_bot/bot_instance.py так же, как при работе бота (send_message подменен заглушкой)
+
+Каждый юзер шлет следующее сообщение только после ответа бота и паузы "на подумать"
+(экспоненциальная со средним --think секунд). Для каждого числа юзеров выводит пропускную способность
+и p50/p95/p99 задержки ответа по обработчикам и по переходам между стадиями
+
+Упавшие обработчики и апдейты без ответа логируются и считаются ошибками; если ошибки были,
+после всех прогонов выводится сводка по типам исключений и код возврата - 1
+
+    python -m bench.load --users 10 50 100 200 --duration 30 --think 1.0
+"""
+import argparse
+import heapq
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from .common import use_database, reset_database, fill_tagged_toasts, fill_users, summarize
+from typing import Any, Dict, Iterator, List, Optional
+
+
+def user_script(rng: random.Random, vocabulary: List[str]) -> Iterator[str]:
+    """
+    Сообщения одного юзера: команды, кнопки меню, реакции на тосты и теги своими словами
+    """
+    def tags() -> str:
+        return ' '.join(rng.sample(vocabulary, rng.randint(1, 3)))
+
+    yield '/start'
+    yield rng.choice(['Перейти к использованию', 'Расскажи, что ты умеешь!'])
+    while True:
+        yield rng.choice(['Выбери тост', 'Сгенерируй тост'])
+        with_tags = rng.random() < 0.5
+        if with_tags:
+            yield 'Тост по тегам'
+            yield tags()
+        else:
+            yield 'Рандомный тост'
+
+        for _ in range(rng.randint(1, 8)):
+            yield rng.choice(['👍', '👎'])
+            if with_tags and rng.random() < 0.1:
+                yield 'Изменить теги'
+                yield tags()
+
+        if rng.random() < 0.1:
+            yield '/help'
+        yield 'На главную'
+
+
+class LoadRun:
+    """
+    Один прогон: users юзеров в течение duration секунд
+
+    Очередь юзеров, готовых написать, - куча по времени; пишет в бота один поток, а ответы приходят
+    из потоков-обработчиков бота в заглушку send_message
+    """
+
+    def __init__(self, bot: Any, users: int, first_chat_id: int, think: float, duration: float,
+                 vocabulary: List[str], seed: int):
+        self.bot: Any = bot
+        self.think: float = think
+        self.duration: float = duration
+        self.rng: random.Random = random.Random(seed)
+        self.scripts: Dict[int, Iterator[str]] = {
+            chat_id: user_script(random.Random(seed + chat_id), vocabulary)
+            for chat_id in range(first_chat_id, first_chat_id + users)}
+        self.ready: List = [(0.0, chat_id) for chat_id in self.scripts]
+        # chat_id -> (id сообщения, время отправки, текст, стадия до сообщения, обработчик)
+        self.inflight: Dict[int, List[Any]] = {}
+        self.update_id: int = 0
+        self.condition: threading.Condition = threading.Condition()
+        self.handlers: Dict[str, List[float]] = defaultdict(list)
+        self.transitions: Dict[str, List[float]] = defaultdict(list)
+        self.latencies: List[float] = []
+        self.errors: Counter = Counter()
+
+    def make_update(self, chat_id: int, text: str) -> Any:
+        """
+        Апдейт с текстовым сообщением от юзера, как его присылает Telegram
+        """
+        from telebot import types
+
+        self.update_id += 1
+        user = {'id': chat_id, 'is_bot': False, 'first_name': f"user{chat_id}"}
+        message = {'message_id': self.update_id, 'date': int(time.time()), 'text': text,
+                   'chat': {'id': chat_id, 'type': 'private', 'first_name': user['first_name']}, 'from': user}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        return types.Update.de_json({'update_id': self.update_id, 'message': message})
+
+    def send_message(self, chat_id: int, text: str, **kwargs: Any) -> None:
+        """
+        Заглушка bot.send_message: фиксируем задержку ответа и планируем следующее сообщение юзера
+        """
+        from utils import get_last_stage
+
+        now = time.perf_counter()
+        stage = get_last_stage(chat_id)
+        with self.condition:
+            _, sent, _, stage_before, handler = self.inflight.pop(chat_id)
+            latency = (now - sent) * 1000
+            self.latencies.append(latency)
+            self.handlers[handler].append(latency)
+            self.transitions[f"{stage_before} -> {stage}"].append(latency)
+            self.schedule(chat_id, now)
+
+    def schedule(self, chat_id: int, now: float) -> None:
+        """
+        Юзер напишет снова после паузы (вызывать под self.condition)
+        """
+        pause = self.rng.expovariate(1 / self.think) if self.think else 0
+        heapq.heappush(self.ready, (now + pause, chat_id))
+        self.condition.notify()
+
+    def instrument(self, function: Any) -> Any:
+        """
+        Обертка обработчика: запоминаем, какой обработчик ответил. Если он упал или не ответил, логируем
+        и считаем ошибку по типу исключения, а юзер пишет дальше
+        """
+        def handler(message: Any) -> None:
+            chat_id = message.chat.id
+            with self.condition:
+                self.inflight[chat_id][4] = function.__name__
+            error = None
+            try:
+                function(message)
+            except Exception as exception:
+                error = type(exception).__name__
+                logging.exception(f"{function.__name__} failed for chat {chat_id} on {message.text!r}")
+            finally:
+                with self.condition:
+                    # Если ответ был, юзер мог уже отправить следующее сообщение - его не трогаем
+                    if chat_id in self.inflight and self.inflight[chat_id][0] == message.message_id:
+                        self.inflight.pop(chat_id)
+                        if error is None:
+                            error = 'NoReply'
+                            logging.error(f"{function.__name__} sent no reply to chat {chat_id} on {message.text!r}")
+                        self.errors[error] += 1
+                        self.schedule(chat_id, time.perf_counter())
+        return handler
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Прогон и сводка результатов
+        """
+        from utils import get_last_stage
+
+        originals = [(handler, handler['function']) for handler in self.bot.message_handlers]
+        send_message = self.bot.send_message
+        for handler, function in originals:
+            handler['function'] = self.instrument(function)
+        self.bot.send_message = self.send_message
+
+        start = time.perf_counter()
+        stop = start + self.duration
+        try:
+            while True:
+                with self.condition:
+                    while True:
+                        now = time.perf_counter()
+                        if now >= stop:
+                            break
+                        if self.ready and self.ready[0][0] <= now:
+                            break
+                        self.condition.wait(min(stop, self.ready[0][0]) - now if self.ready else stop - now)
+                    if now >= stop:
+                        break
+                    chat_id = heapq.heappop(self.ready)[1]
+
+                text = next(self.scripts[chat_id])
+                stage = get_last_stage(chat_id)
+                update = self.make_update(chat_id, text)
+                with self.condition:
+                    self.inflight[chat_id] = [update.message.message_id, time.perf_counter(), text, stage, None]
+                self.bot.process_new_updates([update])
+
+            # Дожидаемся ответов на уже отправленное
+            self.bot.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            for handler, function in originals:
+                handler['function'] = function
+            self.bot.send_message = send_message
+
+        return {
+            'users': len(self.scripts),
+            'think_s': self.think,
+            'elapsed_s': round(elapsed, 2),
+            'messages': len(self.latencies),
+            'errors': sum(self.errors.values()),
+            'error_types': dict(self.errors),
+            'throughput_msg_s': round(len(self.latencies) / elapsed, 2),
+            'latency': summarize(self.latencies) if self.latencies else None,
+            'handlers': {name: {'count': len(times), **summarize(times)} for name, times in self.handlers.items()},
+            'transitions': {name: {'count': len(times), **summarize(times)}
+                            for name, times in sorted(self.transitions.items())},
+        }
+
+
+def prepare(toasts: int, seed: int, generation_workers: Optional[int]) -> List[str]:
+    """
+    Синтетический корпус, модели и индексы - как после первого запуска бота. Возвращает словарь корпуса
+    """
+    from utils import (
+        Base,
+        engine,
+        tfidf_model,
+        tag_index,
+        stage_cache,
+        build_markov_artifact,
+        generation_pool
+    )
+    from utils.database_services import select_all_toasts
+    from utils.text_services import preprocess_many
+
+    reset_database(engine, Base)
+    vocabulary = fill_tagged_toasts(toasts, seed=seed)
+    fill_users(engine, 0, toasts, 0, vocabulary, seed=seed)
+
+    tfidf_model.fit([" ".join(lemmas) for lemmas in preprocess_many(select_all_toasts())])
+    if generation_workers is not None:
+        generation_pool.workers = generation_workers
+    build_markov_artifact(cache=not generation_pool.workers)
+    tag_index.sync()
+    stage_cache.load()
+    generation_pool.start()
+    return vocabulary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, nargs='+', default=[10, 50, 100], help='числа одновременных юзеров')
+    parser.add_argument('--duration', type=float, default=30, help='длительность прогона для каждого числа юзеров, сек')
+    parser.add_argument('--think', type=float, default=1.0, help='средняя пауза юзера между сообщениями, сек')
+    parser.add_argument('--toasts', type=int, default=10000, help='размер корпуса')
+    parser.add_argument('--generation-workers', type=int, default=None,
+                        help='процессов для генерации (по умолчанию GENERATION_WORKERS)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='куда записать результат (по умолчанию - в stdout)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(threadName)s %(message)s")
+    use_database()
+    vocabulary = prepare(args.toasts, args.seed, args.generation_workers)
+    from telegram_bot import bot
+
+    results = []
+    first_chat_id = 1
+    for users in args.users:
+        # Каждый прогон - новые юзеры, чтобы они начинали с /start
+        result = LoadRun(bot, users, first_chat_id, args.think, args.duration, vocabulary, args.seed).run()
+        first_chat_id += users
+        results.append(result)
+        summary = {key: result[key] for key in ('users', 'messages', 'errors', 'throughput_msg_s')}
+        summary['p99_ms'] = result['latency'] and result['latency']['p99_ms']
+        print(json.dumps(summary), file=sys.stderr)
+
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+    # Ошибки под нагрузкой - это регрессия, а не просто цифра в отчете
+    errors = Counter()
+    for result in results:
+        errors.update(result['error_types'])
+    if errors:
+        print(f"ERRORS {sum(errors.values())}: {json.dumps(dict(errors))}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Бенчмарк препроцессинга: старый путь (nltk.word_tokenize + morph.parse на каждый токен)
+против регулярки и кэша лемм. Проверяет, что леммы совпадают, и меряет ускорение
+
+По умолчанию сравнивает на тостах из bench/fixtures/toasts.txt - в них есть кавычки, дефисы, тире,
+сокращения и числа, на которых регулярка и nltk могут разойтись. Синтетический корпус из слогов
+годится только для замера скорости
+
+    python -m bench.preprocess
+    python -m bench.preprocess --database toasts.db
+    python -m bench.preprocess --synthetic --count 5000
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from .common import use_database, make_word, make_toast
+
+# Тосты с сайтов, разделенные пустой строкой
+SAMPLE_FILE = Path(__file__).parent / 'fixtures' / 'toasts.txt'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database', default=None, help='sqlite-файл с тостами (по умолчанию тосты из bench/fixtures)')
+    parser.add_argument('--synthetic', action='store_true', help='синтетический корпус из слогов (только для скорости)')
+    parser.add_argument('--count', type=int, default=5000, help='сколько тостов обработать (для --database и --synthetic)')
+    parser.add_argument('--examples', type=int, default=5, help='сколько расхождений показать')
+    args = parser.parse_args()
+
+    use_database(args.database)
+    from string import punctuation
+    from nltk.tokenize import word_tokenize
+    from utils.text_services import get_morph, get_stop_words, lemma_cache, preprocess_text
+
+    if args.database:
+        from utils.database_services import create_session
+        from utils.models import Toast
+        session = create_session()
+        texts = [row[0] for row in session.query(Toast.toast_text).limit(args.count)]
+        session.close()
+    elif args.synthetic:
+        rng = random.Random(0)
+        vocabulary = list({make_word(rng) for _ in range(5000)})
+        texts = [make_toast(rng, vocabulary) for _ in range(args.count)]
+    else:
+        texts = [text.strip() for text in SAMPLE_FILE.read_text(encoding='utf-8').split('\n\n') if text.strip()]
+
+    morph = get_morph()
+    stop_words = get_stop_words()
+
+    def old_preprocess(message):
+        return [morph.parse(token.strip(punctuation + '–'))[0].normal_form.replace('h', 'н')
+                for token in word_tokenize(message)
+                if token.strip(punctuation + '–') and token not in stop_words and not token.isdigit()]
+
+    start = time.perf_counter()
+    expected = [old_preprocess(text) for text in texts]
+    old_time = time.perf_counter() - start
+
+    # Холодный кэш: первый проход по корпусу, как при заливке
+    lemma_cache.clear()
+    start = time.perf_counter()
+    actual = [preprocess_text(text) for text in texts]
+    cold_time = time.perf_counter() - start
+
+    # Теплый кэш: как при обработке сообщений юзеров работающим ботом
+    start = time.perf_counter()
+    [preprocess_text(text) for text in texts]
+    warm_time = time.perf_counter() - start
+
+    mismatches = [(text, old, new) for text, old, new in zip(texts, expected, actual) if old != new]
+    for text, old, new in mismatches[:args.examples]:
+        print(json.dumps({'text': text[:200], 'old': old, 'new': new}, ensure_ascii=False), file=sys.stderr)
+
+    print(json.dumps({
+        'texts': len(texts),
+        'mismatches': len(mismatches),
+        'cached_lemmas': len(lemma_cache),
+        'old_s': round(old_time, 3),
+        'cold_s': round(cold_time, 3),
+        'warm_s': round(warm_time, 3),
+        'speedup_cold': round(old_time / cold_time, 2),
+        'speedup_warm': round(old_time / warm_time, 2),
+    }, ensure_ascii=False))
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Бенчмарк выбора случайного непросмотренного тоста:
+старый запрос (NOT IN + ORDER BY random()) против выборки по карте просмотренных
+
+    python -m bench.random_select --sizes 10000 100000 1000000
+"""
+import argparse
+import json
+import random
+from .common import use_database, reset_database, fill_toasts, timed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--seen', type=float, default=0.1, help='доля тостов, которые юзер уже видел')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    use_database()
+    from sqlalchemy import insert, and_
+    from sqlalchemy.sql import func
+    from utils import Base, engine, seen_cache
+    from utils.models import Toast, ToastToUser
+    from utils.database_services import create_session, select_random_toasts
+
+    chat_id = 1
+    results = []
+    for size in args.sizes:
+        reset_database(engine, Base)
+        fill_toasts(engine, size)
+
+        # История просмотров юзера
+        rng = random.Random(size)
+        seen_ids = rng.sample(range(1, size + 1), int(size * args.seen))
+        with engine.begin() as connection:
+            connection.execute(insert(ToastToUser), [{'chat_id': chat_id, 'toast_id': toast_id, 'user_like': True}
+                                                     for toast_id in seen_ids])
+
+        def old_query():
+            session = create_session()
+            session.query(Toast.toast_text, Toast.id) \
+                .join(ToastToUser, ToastToUser.toast_id == Toast.id, isouter=True) \
+                .filter(Toast.id.not_in(
+                    session.query(ToastToUser.toast_id)
+                    .filter(and_(ToastToUser.chat_id == chat_id, ToastToUser.toast_id != None))
+                    .subquery())) \
+                .order_by(func.random()).first()
+            session.close()
+
+        # Первое обращение загружает карту просмотренных, его меряем отдельно
+        seen_cache.clear()
+        cold = timed(lambda: select_random_toasts(chat_id), 1)
+
+        results.append({
+            'toasts': size,
+            'seen': len(seen_ids),
+            'order_by_random': timed(old_query, max(1, args.repeat // 10)),
+            'sampler_cold': cold,
+            'sampler': timed(lambda: select_random_toasts(chat_id), args.repeat),
+        })
+        print(json.dumps(results[-1], ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
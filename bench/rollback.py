@@ -0,0 +1,76 @@
+"""
+Проверка кэшей стадий и просмотренных тостов при откате апдейта
+
+Апдейт меняет стадию юзера и отмечает тост просмотренным, а потом падает. После отката то, что отдают кэши,
+должно совпадать с тем, что читается из БД с пустыми кэшами; то же - после закоммиченного апдейта.
+Внутри самого апдейта его изменения должны быть видны
+
+    python -m bench.rollback
+"""
+import json
+import sys
+from .common import use_database, reset_database, fill_tagged_toasts, fill_users
+from typing import Any, Dict
+
+
+def snapshot(chat_id: int, toasts: int) -> Dict[str, Any]:
+    """
+    Стадия юзера и просмотренные тосты - из кэшей и из БД (с очищенными кэшами)
+    """
+    from utils import stage_cache, seen_cache, get_last_stage
+
+    cached = {'stage': get_last_stage(chat_id), 'seen': [i for i in range(1, toasts + 1) if i in seen_cache.get(chat_id)]}
+    stage_cache.current.clear()
+    seen_cache.clear()
+    stored = {'stage': get_last_stage(chat_id), 'seen': [i for i in range(1, toasts + 1) if i in seen_cache.get(chat_id)]}
+    return {'cached': cached, 'stored': stored}
+
+
+def update(chat_id: int, stage: str, toast_id: int, fail: bool) -> bool:
+    """
+    Апдейт в одной транзакции: новая стадия и просмотренный тост, при fail - падение перед коммитом.
+    Возвращает, видны ли изменения внутри транзакции
+    """
+    from utils import session_scope, seen_cache, get_last_stage, add_stage, add_toast_seen
+
+    try:
+        with session_scope() as session:
+            add_stage(chat_id, stage, session=session)
+            add_toast_seen(chat_id, toast_id=toast_id, session=session)
+            visible = get_last_stage(chat_id, session=session) == stage and toast_id in seen_cache.get(chat_id, session)
+            if fail:
+                raise RuntimeError('update failed')
+    except RuntimeError:
+        pass
+    return visible
+
+
+def main() -> None:
+    use_database()
+    from utils import Base, engine, stage_cache, add_stage, add_toast_seen
+
+    toasts, chat_id = 100, 1
+    reset_database(engine, Base)
+    vocabulary = fill_tagged_toasts(toasts)
+    fill_users(engine, 0, toasts, 0, vocabulary)
+    stage_cache.load()
+
+    add_stage(chat_id, 'main menu')
+    add_toast_seen(chat_id, toast_id=1)
+
+    ok = True
+    for name, stage, toast_id, fail in (('rollback', 'select tag', 2, True), ('commit', 'select tag', 3, False)):
+        visible = update(chat_id, stage, toast_id, fail)
+        result = snapshot(chat_id, toasts)
+        expected = {'stage': 'main menu' if fail else stage, 'seen': [1] if fail else [1, toast_id]}
+        passed = visible and result['cached'] == result['stored'] == expected
+        ok &= passed
+        print(json.dumps({'update': name, 'visible_in_transaction': visible, **result, 'ok': passed},
+                         ensure_ascii=False))
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+Набор бенчмарков горячих функций бота на синтетических корпусах и юзерах
+
+Для каждого масштаба (число тостов x число юзеров) заливает корпус с тегами и историю юзеров,
+меряет функции из database_services и генерацию по модели Маркова и пишет результат в JSON.
+Если задан baseline, сравнивает с ним p50 и завершается с кодом 1, если что-то замедлилось больше, чем на --threshold
+
+    python -m bench.suite --toasts 10000 100000 --users 1000 --output bench.json --save-baseline bench/baseline.json
+    python -m bench.suite --toasts 10000 100000 --users 1000 --baseline bench/baseline.json
+"""
+import argparse
+import json
+import platform
+import random
+import sqlite3
+import sys
+from .common import use_database, reset_database, fill_tagged_toasts, fill_users, make_toast, timed
+from typing import Any, Dict, List
+
+
+def run_scale(toasts: int, users: int, args: argparse.Namespace) -> Dict[str, Dict[str, float]]:
+    """
+    Заливка данных одного масштаба и замеры всех функций
+    """
+    from utils import (
+        Base,
+        engine,
+        tag_index,
+        tag_vocabulary,
+        seen_cache,
+        stage_cache,
+        generated_cache,
+        markov_cache,
+        get_markov,
+        get_sentence_fit
+    )
+    from utils.database_services import (
+        add_toast,
+        get_all_generated,
+        get_last_stage,
+        select_random_toasts,
+        select_tag_toasts
+    )
+
+    reset_database(engine, Base)
+    for cache in (tag_index, tag_vocabulary, seen_cache, generated_cache, markov_cache):
+        cache.clear()
+    stage_cache.current.clear()
+
+    vocabulary = fill_tagged_toasts(toasts, seed=args.seed)
+    fill_users(engine, users, toasts, args.history, vocabulary, seed=args.seed)
+    stage_cache.load()
+
+    # Запросы идут от случайных юзеров, так что при большом числе юзеров кэши в основном холодные - как в жизни
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+
+    def chat_ids() -> int:
+        return rng.randint(1, users)
+
+    with engine.connect() as connection:
+        texts = [text[0] for text in connection.exec_driver_sql(
+            f"SELECT toast_text FROM toasts LIMIT {args.markov_texts}")]
+    model = get_markov(texts)
+    chats = iter(range(users + 1, users + 1 + args.repeat * 2))
+
+    result = {
+        'select_tag_toasts': timed(lambda: select_tag_toasts(chat_ids(), tags=rng.sample(vocabulary, 3)), args.repeat),
+        'select_random_toasts': timed(lambda: select_random_toasts(chat_ids()), args.repeat),
+        'get_last_stage': timed(lambda: get_last_stage(chat_ids()), args.repeat),
+        'get_all_generated': timed(lambda: get_all_generated(chat_ids()), args.repeat),
+        'add_toast': timed(lambda: add_toast(rng.sample(vocabulary, 10), make_toast(rng, vocabulary)), args.repeat),
+        'get_markov': timed(lambda: get_markov(rng.sample(texts, len(texts))), max(1, args.repeat // 10)),
+        # Каждый раз новый юзер, чтобы не попадать в отложенных кандидатов
+        'get_sentence_fit': timed(lambda: get_sentence_fit(model, next(chats), 'bench'), args.repeat),
+    }
+    return result
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    Сравнение p50 с baseline. Возвращает список замедлившихся замеров
+    """
+    regressions = []
+    for scale, functions in results['results'].items():
+        for name, timings in functions.items():
+            base = baseline.get('results', {}).get(scale, {}).get(name)
+            if not base or not base['p50_ms']:
+                continue
+            ratio = timings['p50_ms'] / base['p50_ms']
+            timings['baseline_p50_ms'] = base['p50_ms']
+            timings['ratio'] = round(ratio, 3)
+            if ratio > 1 + threshold:
+                regressions.append(f"{scale} {name}: p50 {base['p50_ms']} -> {timings['p50_ms']} ms (x{ratio:.2f})")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--toasts', type=int, nargs='+', default=[10000, 100000], help='размеры корпуса')
+    parser.add_argument('--users', type=int, nargs='+', default=[1000], help='числа юзеров')
+    parser.add_argument('--history', type=int, default=50, help='сколько тостов в истории каждого юзера')
+    parser.add_argument('--repeat', type=int, default=200, help='сколько раз вызываем каждую функцию')
+    parser.add_argument('--markov-texts', type=int, default=2000, help='на скольких тостах строим модель Маркова')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='куда записать результат (по умолчанию - в stdout)')
+    parser.add_argument('--baseline', default=None, help='JSON с прошлым результатом для сравнения')
+    parser.add_argument('--save-baseline', default=None, help='записать результат еще и как baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='допустимое замедление p50 (0.2 - на 20%%)')
+    args = parser.parse_args()
+
+    use_database()
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'machine': platform.machine(),
+            'args': {key: value for key, value in vars(args).items()
+                     if key not in ('output', 'baseline', 'save_baseline')},
+        },
+        'results': {},
+    }
+    for toasts in args.toasts:
+        for users in args.users:
+            scale = f"{toasts}x{users}"
+            results['results'][scale] = run_scale(toasts, users, args)
+            print(scale, json.dumps({name: timings['p50_ms'] for name, timings in results['results'][scale].items()}),
+                  file=sys.stderr)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        results['regressions'] = regressions
+
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as baseline_file:
+            baseline_file.write(output)
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
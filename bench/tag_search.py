@@ -0,0 +1,64 @@
+"""
+Бенчмарк поиска тоста по тегам: индекс тегов (TAG_BACKEND=index)
+против косинусной близости по матрице tf-idf (TAG_BACKEND=similarity)
+
+    python -m bench.tag_search --sizes 10000 50000 100000
+"""
+import argparse
+import json
+import random
+from .common import use_database, reset_database, make_toast, make_word, timed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000, 100000])
+    parser.add_argument('--queries', type=int, default=200, help='сколько разных запросов прогнать')
+    parser.add_argument('--query-words', type=int, default=3)
+    args = parser.parse_args()
+
+    use_database()
+    from utils import Base, engine, tag_index, tag_vocabulary, similarity_index, tfidf_model, seen_cache
+    from utils import database_services
+    from utils.bulk_writer import BulkWriter
+    from utils.text_services import preprocess_many, create_tfidf, get_top_tf_idf_batch
+
+    chat_id = 1
+    results = []
+    for size in args.sizes:
+        reset_database(engine, Base)
+        tag_index.clear()
+        tag_vocabulary.clear()
+        similarity_index.clear()
+        seen_cache.clear()
+
+        # Заливаем корпус так же, как при первом запуске: теги - 10 лучших слов по tf-idf, затем модель tf-idf
+        rng = random.Random(size)
+        vocabulary = list({make_word(rng) for _ in range(5000)})
+        texts = [make_toast(rng, vocabulary) for _ in range(size)]
+        texts_preprocessed = [" ".join(lemmas) for lemmas in preprocess_many(texts)]
+        toasts_tfidf, feature_names = create_tfidf(texts_preprocessed)
+        with BulkWriter() as writer:
+            for text, tags in zip(texts, get_top_tf_idf_batch(toasts_tfidf, feature_names, 10)):
+                writer.add(text, tags)
+        tfidf_model.fit(texts_preprocessed)
+
+        # Запросы - случайные слова из словаря модели
+        queries = [rng.sample(list(tfidf_model.feature_names), args.query_words) for _ in range(args.queries)]
+
+        result = {'toasts': size}
+        for backend in ('index', 'similarity'):
+            database_services.TAG_BACKEND = backend
+            # Первый поиск строит индекс (для similarity - векторизует весь корпус), его меряем отдельно
+            result[f"{backend}_build"] = timed(lambda: database_services.select_tag_toasts(
+                chat_id, tags=queries[0]), 1)
+            query_iter = iter(queries * 2)
+            result[backend] = timed(lambda: database_services.select_tag_toasts(
+                chat_id, tags=next(query_iter)), args.queries)
+
+        results.append(result)
+        print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,48 @@
 from .config import (
     TELEGRAM_API,
     DATABASE,
+    ARTIFACTS_DIR,
     USER_STAGES,
-    PARSE_URLS
-)
\ No newline at end of file
+    PARSE_URLS,
+    MARKOV_CACHE_SIZE,
+    MARKOV_CACHE_CHARS,
+    MARKOV_BATCH_SIZE,
+    MARKOV_MAX_ATTEMPTS,
+    MARKOV_TIME_BUDGET,
+    MARKOV_POOL_SIZE,
+    MARKOV_POOL_CHATS,
+    SEEN_CACHE_BYTES,
+    SEEN_SNAPSHOT_EVERY,
+    GENERATED_CACHE_SIZE,
+    STAGE_CACHE_SIZE,
+    STAGE_HISTORY,
+    STAGE_HISTORY_BATCH,
+    CRAWL_WORKERS,
+    CRAWL_PER_HOST,
+    CRAWL_DELAY,
+    CRAWL_MAX_ATTEMPTS,
+    CRAWL_BACKOFF,
+    CRAWL_TIMEOUT,
+    PREPROCESS_WORKERS,
+    PREPROCESS_CHUNK,
+    LEMMA_CACHE_SIZE,
+    LEMMA_CACHE_FILE,
+    TAG_BACKEND,
+    SIMILARITY_SAVE_ROWS,
+    BOT_WORKERS,
+    BOT_QUEUE_SIZE,
+    SQLITE_WAL,
+    SQLITE_BUSY_TIMEOUT,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+    GENERATION_WORKERS,
+    GENERATION_DEADLINE,
+    COMPACTION_POLICY,
+    COMPACTION_ARCHIVE,
+    COMPACTION_BATCH,
+    COMPACTION_PAUSE,
+    COMPACTION_INTERVAL
+)
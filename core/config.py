@@ -10,6 +10,10 @@ TELEGRAM_API = os.getenv(key="TELEGRAM_API")
 # Адрес базы данных
 DATABASE = os.getenv(key="DATABASE")
 
+# Папка для артефактов (скомпилированные модели и т.п.), по умолчанию - рядом с файлом sqlite базы
+ARTIFACTS_DIR = os.getenv(key="ARTIFACTS_DIR") or os.path.dirname(
+    DATABASE.split(':///', 1)[-1] if DATABASE and DATABASE.startswith('sqlite') else '') or '.'
+
 # Сайты для парсинга
 PARSE_URLS = ['https://alcofan.com/luchshie-tosty-interneta',
         'http://www.toast.ru/toast/',
@@ -26,3 +30,83 @@ USER_STAGES = ['start',
           'select random',
           'select tag choose',
           'select tag']
+
+# Кэш моделей Маркова: максимум моделей в памяти и суммарный размер их корпусов (в символах)
+MARKOV_CACHE_SIZE = int(os.getenv(key="MARKOV_CACHE_SIZE", default=32))
+MARKOV_CACHE_CHARS = int(os.getenv(key="MARKOV_CACHE_CHARS", default=50_000_000))
+
+# Генерация тостов: размер пачки кандидатов, лимиты попыток и времени (в секундах) на один тост,
+# сколько запасных кандидатов держим для юзера и для скольких юзеров
+MARKOV_BATCH_SIZE = int(os.getenv(key="MARKOV_BATCH_SIZE", default=10))
+MARKOV_MAX_ATTEMPTS = int(os.getenv(key="MARKOV_MAX_ATTEMPTS", default=200))
+MARKOV_TIME_BUDGET = float(os.getenv(key="MARKOV_TIME_BUDGET", default=1.0))
+MARKOV_POOL_SIZE = int(os.getenv(key="MARKOV_POOL_SIZE", default=20))
+MARKOV_POOL_CHATS = int(os.getenv(key="MARKOV_POOL_CHATS", default=10000))
+
+# Кэш битовых карт просмотренных тостов: суммарный размер в байтах
+SEEN_CACHE_BYTES = int(os.getenv(key="SEEN_CACHE_BYTES", default=64_000_000))
+# Снимок карты в seen_bitmaps пишем раз в столько новых просмотров юзера (карта восстанавливается
+# из снимка и записей toast_to_user после него, так что между снимками ничего не теряется)
+SEEN_SNAPSHOT_EVERY = int(os.getenv(key="SEEN_SNAPSHOT_EVERY", default=100))
+
+# Кэш хэшей сгенерированных тостов, которые видели юзеры: сколько хэшей держим в памяти
+GENERATED_CACHE_SIZE = int(os.getenv(key="GENERATED_CACHE_SIZE", default=500_000))
+
+# Текущие стадии юзеров: сколько держим в памяти; писать ли историю стадий в stage_to_user и какими пачками
+STAGE_CACHE_SIZE = int(os.getenv(key="STAGE_CACHE_SIZE", default=100000))
+STAGE_HISTORY = os.getenv(key="STAGE_HISTORY", default="0") == "1"
+STAGE_HISTORY_BATCH = int(os.getenv(key="STAGE_HISTORY_BATCH", default=100))
+
+# Парсинг сайтов: число потоков, одновременных запросов к одному хосту, пауза между запросами к хосту (сек),
+# максимум попыток на страницу, база экспоненциальной задержки между попытками (сек) и таймаут запроса (сек)
+CRAWL_WORKERS = int(os.getenv(key="CRAWL_WORKERS", default=8))
+CRAWL_PER_HOST = int(os.getenv(key="CRAWL_PER_HOST", default=2))
+CRAWL_DELAY = float(os.getenv(key="CRAWL_DELAY", default=0.5))
+CRAWL_MAX_ATTEMPTS = int(os.getenv(key="CRAWL_MAX_ATTEMPTS", default=5))
+CRAWL_BACKOFF = float(os.getenv(key="CRAWL_BACKOFF", default=1.0))
+CRAWL_TIMEOUT = float(os.getenv(key="CRAWL_TIMEOUT", default=30))
+
+# Препроцессинг при заливке: число процессов (по умолчанию - по числу ядер) и размер пачки текстов для процесса
+PREPROCESS_WORKERS = int(os.getenv(key="PREPROCESS_WORKERS", default=os.cpu_count() or 1))
+PREPROCESS_CHUNK = int(os.getenv(key="PREPROCESS_CHUNK", default=500))
+
+# Кэш лемм: сколько токенов помним и файл, в котором кэш хранится между запусками (если не задан - не храним)
+LEMMA_CACHE_SIZE = int(os.getenv(key="LEMMA_CACHE_SIZE", default=200000))
+LEMMA_CACHE_FILE = os.getenv(key="LEMMA_CACHE_FILE")
+
+# Поиск тостов по тегам: 'index' - по совпадению тегов (индекс тегов), 'similarity' - по косинусной близости tf-idf
+TAG_BACKEND = os.getenv(key="TAG_BACKEND", default="index")
+# Матрицу для 'similarity' пересохраняем артефактом, когда в ней набралось столько строк после прошлого сохранения
+SIMILARITY_SAVE_ROWS = int(os.getenv(key="SIMILARITY_SAVE_ROWS", default=1000))
+
+# Обработка апдейтов бота: число потоков-обработчиков и длина очереди апдейтов у каждого потока
+BOT_WORKERS = int(os.getenv(key="BOT_WORKERS", default=8))
+BOT_QUEUE_SIZE = int(os.getenv(key="BOT_QUEUE_SIZE", default=100))
+
+# SQLite под несколько потоков-обработчиков: журнал WAL (чтение не ждет записи, записи не мешают чтению)
+# и сколько миллисекунд писатель ждет блокировку записи, прежде чем упасть с "database is locked"
+SQLITE_WAL = os.getenv(key="SQLITE_WAL", default="1") == "1"
+SQLITE_BUSY_TIMEOUT = int(os.getenv(key="SQLITE_BUSY_TIMEOUT", default=30000))
+
+# Режим вебхука: адрес и порт локального HTTP-сервера, путь для апдейтов, секрет (заголовок
+# X-Telegram-Bot-Api-Secret-Token) и внешний адрес, который регистрируем в Telegram (если не задан - не регистрируем)
+WEBHOOK_HOST = os.getenv(key="WEBHOOK_HOST", default="127.0.0.1")
+WEBHOOK_PORT = int(os.getenv(key="WEBHOOK_PORT", default=8080))
+WEBHOOK_PATH = os.getenv(key="WEBHOOK_PATH", default="/webhook")
+WEBHOOK_SECRET = os.getenv(key="WEBHOOK_SECRET")
+WEBHOOK_URL = os.getenv(key="WEBHOOK_URL")
+
+# Генерация тостов в отдельных процессах: число процессов (0 - генерируем прямо в потоке бота)
+# и сколько секунд ждем тост, прежде чем отдать юзеру тост из базы
+GENERATION_WORKERS = int(os.getenv(key="GENERATION_WORKERS", default=os.cpu_count() or 1))
+GENERATION_DEADLINE = float(os.getenv(key="GENERATION_DEADLINE", default=2.0))
+
+# Чистка таблиц, которые только растут (stage_to_user, user_tags, toast_to_user): 'off' - не чистим (по умолчанию),
+# 'archive' - старые строки переносим в файл COMPACTION_ARCHIVE (jsonl), 'drop' - удаляем. Включается явно,
+# например COMPACTION_POLICY=archive в .env: чистка удаляет строки из БД, и решать это должен тот, кто запускает бота.
+# Чистим пачками по COMPACTION_BATCH id с паузой COMPACTION_PAUSE сек, полный проход - раз в COMPACTION_INTERVAL сек
+COMPACTION_POLICY = os.getenv(key="COMPACTION_POLICY", default="off")
+COMPACTION_ARCHIVE = os.getenv(key="COMPACTION_ARCHIVE") or os.path.join(ARTIFACTS_DIR, 'archive.jsonl')
+COMPACTION_BATCH = int(os.getenv(key="COMPACTION_BATCH", default=1000))
+COMPACTION_PAUSE = float(os.getenv(key="COMPACTION_PAUSE", default=0.5))
+COMPACTION_INTERVAL = float(os.getenv(key="COMPACTION_INTERVAL", default=3600))
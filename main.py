@@ -1,41 +1,164 @@
+import time
+
+# Время запуска - от него считаем длительность импортов
+START_TIME = time.perf_counter()
+
 from utils import (
     Base,
     engine,
-    PageParser,
     add_stage_name,
-    db_notempty
-
+    db_notempty,
+    build_markov_artifact,
+    preload_markov,
+    ensure_markov_artifact,
+    tfidf_model,
+    tag_index,
+    similarity_index,
+    stage_cache,
+    generation_pool
 )
+from utils.migrations import migrate
+from utils.compaction import compactor
+from utils.text_services import get_morph, get_stop_words
 from telegram_bot import bot
-from core import USER_STAGES, PARSE_URLS
+from telegram_bot.webhook import serve_webhook
+from core import USER_STAGES, PARSE_URLS, TAG_BACKEND, WEBHOOK_HOST, WEBHOOK_PORT
+from contextlib import contextmanager
+from typing import Dict, Iterator
+import argparse
 import logging
+import threading
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Аргументы командной строки. Без аргументов бот запускается с long polling, как раньше
+    """
+    parser = argparse.ArgumentParser(description="Бот-тостоплет")
+    subparsers = parser.add_subparsers(dest='command')
+    serve = subparsers.add_parser('serve', help="запуск бота")
+    serve.add_argument('--webhook', action='store_true',
+                       help="принимать апдейты по вебхуку (локальный HTTP-сервер) вместо long polling")
+    serve.add_argument('--host', default=WEBHOOK_HOST, help="адрес HTTP-сервера для вебхука")
+    serve.add_argument('--port', type=int, default=WEBHOOK_PORT, help="порт HTTP-сервера для вебхука")
+    return parser.parse_args()
+
+
+@contextmanager
+def startup_phase(name: str, timings: Dict[str, float]) -> Iterator[None]:
+    """
+    Замер длительности этапа запуска
+    """
+    start = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - start
+
+
+def log_timings(title: str, timings: Dict[str, float]) -> None:
+    """
+    Запись длительностей этапов в лог
+    """
+    phases = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+    logging.info(f"{title}: {phases}, total {sum(timings.values()):.2f}s")
+
+
+def prepare() -> Dict[str, float]:
+    """
+    Подготовка бота к работе. Возвращает длительности этапов
+    """
+    timings: Dict[str, float] = {}
+
+    # Создание базы данных и миграции схемы
+    with startup_phase('database', timings):
+        Base.metadata.create_all(engine)
+        migrate()
+        empty = not db_notempty()
+
+    # Если в базе нет записей
+    if empty:
+        with startup_phase('ingest', timings):
+            # Парсер (и библиотеки для парсинга) нужен только здесь
+            from utils.parse_schema import PageParser
+            parser = PageParser()
+
+            # Парсим все сайты
+            for url in PARSE_URLS:
+                parser.parse_site(url)
+
+            # Пишем в базу все "стадии" пользователя в боте
+            logging.info('Writing app stage names')
+            for stage in USER_STAGES:
+                add_stage_name(stage)
+
+            # Обучаем tf-idf и собираем модель Маркова по всему корпусу, сохраняем их.
+            # Матрица tf-idf корпуса сразу идет в индекс близости, чтобы не лемматизировать корпус второй раз
+            corpus_tfidf = tfidf_model.fit(parser.corpus_preprocessed)
+            if TAG_BACKEND == 'similarity':
+                similarity_index.add(parser.corpus_ids, corpus_tfidf)
+            build_markov_artifact(cache=not generation_pool.workers)
+
+            logging.info('Data created!')
+
+    # Модель Маркова нужна этому процессу, только если генерируем без пула процессов,
+    # иначе ее загружают сами процессы-генераторы (нужно лишь, чтобы был артефакт)
+    else:
+        with startup_phase('markov', timings):
+            if generation_pool.workers:
+                ensure_markov_artifact()
+            else:
+                preload_markov()
+
+    # Строим индекс для поиска по тегам в памяти и запоминаем названия стадий
+    with startup_phase('indexes', timings):
+        if TAG_BACKEND == 'similarity':
+            similarity_index.sync()
+        else:
+            tag_index.sync()
+        stage_cache.load()
+
+    # Поднимаем процессы для генерации заранее, чтобы первый запрос не ждал их запуска
+    with startup_phase('generation pool', timings):
+        generation_pool.start()
+
+    return timings
+
+
+def warm_up() -> None:
+    """
+    Загрузка того, что не нужно для первого ответа (морфология, стоп-слова, tf-idf) - в фоне, пока бот уже отвечает
+    """
+    timings: Dict[str, float] = {}
+    with startup_phase('morph', timings):
+        get_morph()
+    with startup_phase('stop words', timings):
+        get_stop_words()
+    with startup_phase('tfidf', timings):
+        tfidf_model.ensure()
+    log_timings('Warm-up timings', timings)
 
 
 def main():
-    # Создание базы данных
-    Base.metadata.create_all(engine)
+    args = parse_args()
 
     # Создание лога
-    logging.basicConfig(filename="./logs/app_log.log", filemode="w",
-                        format="%(asctime)s %(levelname)s %(message)s")
+    logging.basicConfig(filename="./logs/app_log.log", filemode="w", level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(threadName)s %(message)s")
     logging.captureWarnings(True)
 
-    # Если в базе нет записей
-    if not db_notempty():
-        parser = PageParser()
+    timings = {'imports': time.perf_counter() - START_TIME}
+    timings.update(prepare())
+    log_timings('Startup timings', timings)
 
-        # Парсим все сайты
-        for url in PARSE_URLS:
-            parser.parse_site(url)
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
 
-        # Пишем в базу все "стадии" пользователя в боте
-        logging.info('Writing app stage names')
-        for stage in USER_STAGES:
-            add_stage_name(stage)
+    # Фоновая чистка старых записей юзеров
+    compactor.start()
 
-        logging.info('Data created!')
+    if args.command == 'serve' and args.webhook:
+        serve_webhook(args.host, args.port)
+    else:
+        bot.polling(none_stop=True, interval=0)
 
-    bot.polling(none_stop=True, interval=0)
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,6 @@
-import telebot
 from core import TELEGRAM_API
+from utils import session_scope
+from .dispatcher import DispatchBot
 from .bot_services import (
     start_response,
     main_menu,
@@ -10,8 +11,8 @@ from .bot_services import (
     toast_decider,
     text_decider)
 
-# Создание экземпляра бота
-bot = telebot.TeleBot(TELEGRAM_API)
+# Создание экземпляра бота (апдейты разных чатов обрабатываются параллельно, одного чата - по порядку)
+bot = DispatchBot(TELEGRAM_API)
 
 
 @bot.message_handler(commands=["start"])
@@ -19,7 +20,8 @@ def start(message):
     """
     Endpoint для команды start
     """
-    response, markup = start_response(chat_id=message.chat.id)
+    with session_scope() as session:
+        response, markup = start_response(chat_id=message.chat.id, session=session)
     bot.send_message(message.chat.id, response.format(
         message.chat.first_name), reply_markup=markup, parse_mode='Markdown')
 
@@ -29,8 +31,9 @@ def menu(message):
     """ 
     Endpoint для команд help и menu
     """
-    response, markup = main_menu(
-        chat_id=message.chat.id, help=message.text == "/help")
+    with session_scope() as session:
+        response, markup = main_menu(
+            chat_id=message.chat.id, help=message.text == "/help", session=session)
     bot.send_message(message.chat.id, response, reply_markup=markup,
                      parse_mode='Markdown')
 
@@ -40,7 +43,8 @@ def select_random(message):
     """
     Endpoint для команды select_random_toast (Выбери любой тост)
     """
-    response, markup = random_select(chat_id=message.chat.id)
+    with session_scope() as session:
+        response, markup = random_select(chat_id=message.chat.id, session=session)
     bot.send_message(message.chat.id, response, reply_markup=markup,
                      parse_mode='Markdown')
 
@@ -50,7 +54,8 @@ def generate_random(message):
     """
     Endpoint для команды generate_random_toast (Сгенерируй произвольный тост)
     """
-    response, markup = random_generate(chat_id=message.chat.id)
+    with session_scope() as session:
+        response, markup = random_generate(chat_id=message.chat.id, session=session)
     bot.send_message(message.chat.id, response, reply_markup=markup,
                      parse_mode='Markdown')
 
@@ -61,8 +66,9 @@ def return_keywords_toast(message):
     Endpoint для команд select_keywords_toast (Выбери тост по тегам) и generate_keywords_toast (Сгенерируй тост по тегам)
     """
     stage_name = 'select tag choose' if message.text == "/select_keywords_toast" else 'generate tag choose'
-    response, markup = gimme_tags(
-        chat_id=message.chat.id, stage_name=stage_name)
+    with session_scope() as session:
+        response, markup = gimme_tags(
+            chat_id=message.chat.id, stage_name=stage_name, session=session)
     bot.send_message(message.chat.id, response, reply_markup=markup,
                      parse_mode='Markdown')
 
@@ -72,21 +78,24 @@ def handle_text(message):
     """
     Endpoint для обработки текстовых запросов
     """
-    if message.text in ["Перейти к использованию", "Расскажи, что ты умеешь!", "Мне нужна помощь", "На главную"]:
-        response, markup = main_menu(
-            chat_id=message.chat.id, help=message.text in ["Расскажи, что ты умеешь!", "Мне нужна помощь"])
-    elif message.text in ["Сгенерируй тост", "Выбери тост"]:
-        request = 'select menu' if message.text == "Выбери тост" else 'generate menu'
-        response, markup = category_menu(
-            stage_name=request, chat_id=message.chat.id)
-    elif message.text in ["Тост по тегам", "Изменить теги"]:
-        response, markup = gimme_tags(
-            chat_id=message.chat.id, update=message.text == "Изменить теги")
-    elif message.text in ["Рандомный тост", "👎", "👍"]:
-        response, markup = toast_decider(
-            chat_id=message.chat.id, prev_reaction=message.text != "👎")
-    else:
-        response, markup = text_decider(
-            chat_id=message.chat.id, message=message.text)
+    # Одна транзакция на апдейт: коммитим до ответа юзеру
+    with session_scope() as session:
+        if message.text in ["Перейти к использованию", "Расскажи, что ты умеешь!", "Мне нужна помощь", "На главную"]:
+            response, markup = main_menu(
+                chat_id=message.chat.id, help=message.text in ["Расскажи, что ты умеешь!", "Мне нужна помощь"],
+                session=session)
+        elif message.text in ["Сгенерируй тост", "Выбери тост"]:
+            request = 'select menu' if message.text == "Выбери тост" else 'generate menu'
+            response, markup = category_menu(
+                stage_name=request, chat_id=message.chat.id, session=session)
+        elif message.text in ["Тост по тегам", "Изменить теги"]:
+            response, markup = gimme_tags(
+                chat_id=message.chat.id, update=message.text == "Изменить теги", session=session)
+        elif message.text in ["Рандомный тост", "👎", "👍"]:
+            response, markup = toast_decider(
+                chat_id=message.chat.id, prev_reaction=message.text != "👎", session=session)
+        else:
+            response, markup = text_decider(
+                chat_id=message.chat.id, message=message.text, session=session)
     bot.send_message(message.chat.id, response,
                      reply_markup=markup, parse_mode='Markdown')
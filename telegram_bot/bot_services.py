@@ -7,10 +7,9 @@ from utils import (
     add_toast_seen,
     select_tag_toasts,
     select_random_toasts,
-    get_all_generated
+    get_user_tags,
+    generation_pool
 )
-import markovify
-import re
 from pathlib import Path
 from typing import (
     Tuple,
@@ -23,12 +22,12 @@ from typing import (
 message_dir = Path(__file__).parent / 'messages'
 
 
-def start_response(chat_id: int) -> Tuple[str, Any]:
+def start_response(chat_id: int, session: Any = None) -> Tuple[str, Any]:
     """
     Метод обработки команды start
     """
     # Добавляем стадию для юзера
-    add_stage(stage='start', chat_id=chat_id)
+    add_stage(stage='start', chat_id=chat_id, session=session)
 
     # Делаем кнопки
     markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
@@ -42,14 +41,14 @@ def start_response(chat_id: int) -> Tuple[str, Any]:
     return message, markup
 
 
-def main_menu(chat_id: int, help: Optional[bool] = True) -> Tuple[str, Any]:
+def main_menu(chat_id: int, help: Optional[bool] = True, session: Any = None) -> Tuple[str, Any]:
     """
     Метод для главного меню и команды help
 
     help: если True, сообщение для help; иначе для главного меню
     """
     # Добавляем стадию для юзера
-    add_stage(stage='main menu', chat_id=chat_id)
+    add_stage(stage='main menu', chat_id=chat_id, session=session)
 
     # Делаем кнопки
     markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
@@ -66,12 +65,12 @@ def main_menu(chat_id: int, help: Optional[bool] = True) -> Tuple[str, Any]:
     return message, markup
 
 
-def category_menu(stage_name: str, chat_id: int) -> Tuple[str, Any]:
+def category_menu(stage_name: str, chat_id: int, session: Any = None) -> Tuple[str, Any]:
     """
     Метод для меню "Сгенерировать тост" и "Выбрать тост"
     """
     # Добавляем стадию для юзера
-    add_stage(stage=stage_name, chat_id=chat_id)
+    add_stage(stage=stage_name, chat_id=chat_id, session=session)
 
     # Делаем кнопки
     markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
@@ -84,7 +83,8 @@ def category_menu(stage_name: str, chat_id: int) -> Tuple[str, Any]:
     return message, markup
 
 
-def gimme_tags(chat_id: int, stage_name: Optional[str] = None, update: Optional[bool] = False) -> Tuple[str, Any]:
+def gimme_tags(chat_id: int, stage_name: Optional[str] = None, update: Optional[bool] = False,
+               session: Any = None) -> Tuple[str, Any]:
     """
     Метод для запроса тегов
 
@@ -93,11 +93,11 @@ def gimme_tags(chat_id: int, stage_name: Optional[str] = None, update: Optional[
     """
     # Добавляем стадию для юзера
     if not stage_name:
-        stage_id = get_last_stage(chat_id, True)
+        stage_id = get_last_stage(chat_id, True, session)
         stage_id += -1 if update else 2  # ПрОиЗОШел ХаРдКоД
-        add_stage(stage_id=stage_id, chat_id=chat_id)
+        add_stage(stage_id=stage_id, chat_id=chat_id, session=session)
     else:
-        add_stage(stage=stage_name, chat_id=chat_id)
+        add_stage(stage=stage_name, chat_id=chat_id, session=session)
 
     # Убираем кнопки
     markup = types.ReplyKeyboardRemove()
@@ -106,30 +106,6 @@ def gimme_tags(chat_id: int, stage_name: Optional[str] = None, update: Optional[
     return message, markup
 
 
-def get_markov(texts: List[str]) -> Any:
-    """
-    Метод получения модели Маркова
-    """
-    return markovify.Text(texts, state_size=3, retain_original=False)
-
-
-def get_sentence_fit(model: Any, chat_id: int) -> str:
-    """
-    Находим подходящий сгенерированный тост
-    """
-    gen_toast = model.make_sentence()
-    all_generated = get_all_generated(chat_id=chat_id)
-
-    # Ищем, пока не найдем что-то, что юзер еще не видел и что не None
-    while not gen_toast or gen_toast in all_generated:
-        gen_toast = model.make_sentence()
-
-    # Если Марков вздумает писать стишки
-    gen_toast = re.sub('\s(?=[A-ZА-Я])', '\n', gen_toast)
-
-    return gen_toast
-
-
 def get_toast_markup(tags: Optional[bool] = False) -> Any:
     """
     Метод, который делает кнопки для всех разделов с тостами
@@ -164,88 +140,127 @@ def tag_not_found():
     return message, markup
 
 
-def random_generate(chat_id: int) -> Tuple[str, Any]:
+def generation_fallback(chat_id: int, tags: Optional[List[str]] = None, session: Any = None) -> Optional[str]:
+    """
+    Запасной вариант, если новый тост не сгенерировался за отведенное время: выбираем тост из базы
+
+    tags - теги юзера, если мы в разделе с тегами
+    """
+    toast = select_tag_toasts(chat_id=chat_id, tags=tags, session=session) if tags is not None \
+        else select_random_toasts(chat_id=chat_id, session=session)
+    if not toast:
+        return None
+
+    # Фиксируем тост в БД
+    add_toast_seen(chat_id=chat_id, toast_id=int(toast[1]), session=session)
+    return toast[0]
+
+
+def nothing_new() -> str:
+    """
+    Сообщение на случай, если юзер пересмотрел вообще все тосты
+    """
+    return 'Новые тосты закончились ☹️ Загляните попозже!'
+
+
+def random_generate(chat_id: int, like_prev: Optional[bool] = False, session: Any = None) -> Tuple[str, Any]:
     """
     Метод для генерации рандомного тоста
+
+    like_prev - True, если юзер лайкнул предыдущий сгенерированный тост
     """
-    # Добавляем стадию для юзера
-    add_stage(stage='generate random', chat_id=chat_id)
+    # Генерируем супер тост в отдельном процессе по модели из всех недизлайканных тостов.
+    # Ждем генерацию до первой записи в БД: пишущая транзакция sqlite блокирует запись другим чатам
+    gen_toast = generation_pool.get(*generation_pool.submit(chat_id=chat_id))[1]
 
-    # Создаем модель по всем недизлаканным тостам
-    model = get_markov(texts=select_random_toasts(chat_id, True))
+    # Отмечаем лайк предыдущего тоста
+    if like_prev:
+        reaction_to_prev_generate(chat_id=chat_id, session=session)
+
+    # Добавляем стадию для юзера
+    add_stage(stage='generate random', chat_id=chat_id, session=session)
 
-    # Генерируем супер тост
-    gen_toast = get_sentence_fit(model=model, chat_id=chat_id)
+    # Не вышло - отдаем тост из базы
+    if not gen_toast:
+        toast = generation_fallback(chat_id=chat_id, session=session)
+        return toast or nothing_new(), get_toast_markup()
 
     # Фиксируем тост в БД
-    add_toast_seen(chat_id=chat_id, gen_toast=gen_toast)
+    add_toast_seen(chat_id=chat_id, gen_toast=gen_toast, session=session)
 
     return gen_toast, get_toast_markup()
 
 
-def tags_generate(chat_id: int, message: Optional[str] = None) -> Tuple[str, Any]:
+def tags_generate(chat_id: int, message: Optional[str] = None, like_prev: Optional[bool] = False,
+                  session: Any = None) -> Tuple[str, Any]:
     """
     Метод для генерации тоста по тегам
 
     message - не None, если юзер только что указал теги
+    like_prev - True, если юзер лайкнул предыдущий сгенерированный тост
     """
+    # Генерируем супер тост в отдельном процессе по модели из найденных по тегам тостов
+    # (как и в random_generate, до записей в БД - новые теги сессия запишет только при коммите)
+    tags = get_user_tags(chat_id=chat_id, message=message, session=session)
+    found, gen_toast = generation_pool.get(*generation_pool.submit(chat_id=chat_id, tags=tags))
+
+    # Отмечаем лайк предыдущего тоста
+    if like_prev:
+        reaction_to_prev_generate(chat_id=chat_id, session=session)
+
     # Добавляем стадию для юзера
-    add_stage(stage='generate random', chat_id=chat_id)
+    add_stage(stage='generate random', chat_id=chat_id, session=session)
 
-    # Пытаемся найти тосты по тегам
-    tag_toasts = select_tag_toasts(
-        chat_id=chat_id, all_toasts=True, message=message)
-    if not tag_toasts:
+    if not found:
         return tag_not_found()
 
-    # Создаем модель
-    tag_model = get_markov(texts=tag_toasts)
-
-    # Генерируем супер тост
-    gen_toast = get_sentence_fit(model=tag_model, chat_id=chat_id)
+    # Не вышло - отдаем тост из базы
+    if not gen_toast:
+        toast = generation_fallback(chat_id=chat_id, tags=tags, session=session)
+        return (toast, get_toast_markup(tags=True)) if toast else tag_not_found()
 
     # Фиксируем тост в БД
-    add_toast_seen(chat_id=chat_id, gen_toast=gen_toast)
+    add_toast_seen(chat_id=chat_id, gen_toast=gen_toast, session=session)
 
     return gen_toast, get_toast_markup(tags=True)
 
 
-def random_select(chat_id: int) -> Tuple[str, Any]:
+def random_select(chat_id: int, session: Any = None) -> Tuple[str, Any]:
     """
     Метод для выбора рандомного тоста
     """
     # Добавляем стадию для юзера
-    add_stage(stage='select random', chat_id=chat_id)
+    add_stage(stage='select random', chat_id=chat_id, session=session)
 
     # Добываем тост
-    toast = select_random_toasts(chat_id=chat_id)
+    toast = select_random_toasts(chat_id=chat_id, session=session)
 
     # Фиксируем тост в БД
-    add_toast_seen(chat_id=chat_id, toast_id=int(toast[1]))
+    add_toast_seen(chat_id=chat_id, toast_id=int(toast[1]), session=session)
 
     return toast[0], get_toast_markup()
 
 
-def tags_select(chat_id: int, message: Optional[str] = None) -> Tuple[str, Any]:
+def tags_select(chat_id: int, message: Optional[str] = None, session: Any = None) -> Tuple[str, Any]:
     """
     Метод для выбора тоста по тегам
 
     message - не None, если юзер только что указал теги
     """
     # Добавляем стадию для юзера
-    add_stage(stage='select tag', chat_id=chat_id)
+    add_stage(stage='select tag', chat_id=chat_id, session=session)
 
     # Добываем тост
-    toast = select_tag_toasts(chat_id=chat_id, message=message)
+    toast = select_tag_toasts(chat_id=chat_id, message=message, session=session)
     if not toast:
         return tag_not_found()
 
     # Фиксируем тост в БД
-    add_toast_seen(chat_id=chat_id, toast_id=int(toast[1]))
+    add_toast_seen(chat_id=chat_id, toast_id=int(toast[1]), session=session)
     return toast[0], get_toast_markup(True)
 
 
-def toast_decider(chat_id: int, prev_reaction: Optional[bool] = True) -> Tuple[str, Any]:
+def toast_decider(chat_id: int, prev_reaction: Optional[bool] = True, session: Any = None) -> Tuple[str, Any]:
     """
     Метод для обработки кнопок. 
     Решает, куда нам идти (вызывается, когда юзер жмет кнопку, которая у нас в нескольких разделах)
@@ -253,37 +268,36 @@ def toast_decider(chat_id: int, prev_reaction: Optional[bool] = True) -> Tuple[s
     prev_reaction - если нажал лайк или дизлайк
     """
     # Получаем предыдущее действие (стадию) юзера
-    stage_name = get_last_stage(chat_id=chat_id)
+    stage_name = get_last_stage(chat_id=chat_id, session=session)
 
     # Если мы присылали тост из БД, и юзеру он не понравился
     if stage_name in ['select random', 'select tag'] and not prev_reaction:
-        reaction_to_prev_select(chat_id=chat_id)
+        reaction_to_prev_select(chat_id=chat_id, session=session)
 
-    # Если мы присылали сгенерированный тост, и юзеру он понравился
-    elif stage_name in ['generate random', 'generate_tag'] and prev_reaction:
-        reaction_to_prev_generate(chat_id=chat_id)
+    # Если мы присылали сгенерированный тост, и юзеру он понравился, лайк отметят после генерации
+    like_prev = stage_name in ['generate random', 'generate_tag'] and prev_reaction
 
     # Решаем, что делать
     if stage_name in ['select menu', 'select random']:
-        return random_select(chat_id=chat_id)
+        return random_select(chat_id=chat_id, session=session)
     elif stage_name in ['generate menu', 'generate random']:
-        return random_generate(chat_id=chat_id)
+        return random_generate(chat_id=chat_id, like_prev=like_prev, session=session)
     elif stage_name == 'select tag':
-        return tags_select(chat_id=chat_id)
+        return tags_select(chat_id=chat_id, session=session)
 
-    return tags_generate(chat_id=chat_id)
+    return tags_generate(chat_id=chat_id, like_prev=like_prev, session=session)
 
 
-def text_decider(chat_id: int, message: str) -> Tuple[str, Any]:
+def text_decider(chat_id: int, message: str, session: Any = None) -> Tuple[str, Any]:
     """
     Метод для обработки текста с клавиатуры 
     """
     # Получаем предыдущее действие (стадию) юзера
-    stage_name = get_last_stage(chat_id=chat_id)
+    stage_name = get_last_stage(chat_id=chat_id, session=session)
     if stage_name == 'select tag choose':
-        message, markup = tags_select(chat_id=chat_id, message=message)
+        message, markup = tags_select(chat_id=chat_id, message=message, session=session)
     elif stage_name == 'generate tag choose':
-        message, markup = tags_generate(chat_id=chat_id, message=message)
+        message, markup = tags_generate(chat_id=chat_id, message=message, session=session)
     
     # Если юзер решил просто пообщаться с ботом, а он не хочет
     else:
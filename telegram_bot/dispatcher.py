@@ -0,0 +1,100 @@
+import logging
+import queue
+import threading
+import telebot
+from core import BOT_WORKERS, BOT_QUEUE_SIZE
+from typing import Any, List, Optional
+
+
+def update_chat_id(update: Any) -> Optional[int]:
+    """
+    chat_id, к которому относится апдейт (None, если апдейт не из чата)
+    """
+    for field in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        message = getattr(update, field, None)
+        if message is not None:
+            return message.chat.id
+
+    callback_query = getattr(update, 'callback_query', None)
+    if callback_query is not None and callback_query.message is not None:
+        return callback_query.message.chat.id
+    return None
+
+
+class DispatchBot(telebot.TeleBot):
+    """
+    Бот, который обрабатывает апдейты на пуле потоков
+
+    Апдейты одного чата всегда попадают в один поток (по хэшу chat_id) и обрабатываются строго по порядку -
+    от этого зависят стадии юзера; разные чаты обрабатываются параллельно.
+    Очереди потоков ограничены: если поток не успевает, прием новых апдейтов ждет
+    """
+
+    def __init__(self, token: str, workers: int = BOT_WORKERS, queue_size: int = BOT_QUEUE_SIZE, **kwargs: Any):
+        # Сами обработчики вызываем в своих потоках, поэтому пул telebot не нужен
+        super().__init__(token, threaded=False, **kwargs)
+        self.workers: int = workers
+        self.queues: List[queue.Queue] = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads: List[threading.Thread] = []
+        self.threads_lock: threading.Lock = threading.Lock()
+
+    def start_workers(self) -> None:
+        """
+        Запуск потоков-обработчиков (один раз, при первом апдейте)
+        """
+        with self.threads_lock:
+            if self.threads:
+                return
+            for i, updates_queue in enumerate(self.queues):
+                thread = threading.Thread(target=self.work, args=(updates_queue,), name=f"bot-worker-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self, updates_queue: queue.Queue) -> None:
+        """
+        Цикл потока-обработчика: апдейты из своей очереди по одному
+        """
+        while True:
+            update = updates_queue.get()
+            try:
+                super().process_new_updates([update])
+            except Exception:
+                logging.exception(f"Can't process update {update.update_id}")
+            finally:
+                updates_queue.task_done()
+
+    def dispatch(self, update: Any, block: bool = True) -> bool:
+        """
+        Постановка апдейта в очередь его чата. Возвращает False, если block=False, а очередь полна
+        """
+        self.start_workers()
+        chat_id = update_chat_id(update)
+        updates_queue = self.queues[hash(chat_id if chat_id is not None else update.update_id) % self.workers]
+        try:
+            updates_queue.put(update, block=block)
+        except queue.Full:
+            return False
+        return True
+
+    def process_new_updates(self, updates: List[Any]) -> None:
+        """
+        Раскладываем апдейты по очередям вместо обработки на месте
+        """
+        for update in updates:
+            # Сдвигаем offset сразу, иначе polling запросит те же апдейты еще раз
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            self.dispatch(update)
+
+    def pending(self) -> int:
+        """
+        Число апдейтов, ожидающих обработки
+        """
+        return sum(updates_queue.qsize() for updates_queue in self.queues)
+
+    def join(self) -> None:
+        """
+        Ожидание обработки всех апдейтов в очередях
+        """
+        for updates_queue in self.queues:
+            updates_queue.join()
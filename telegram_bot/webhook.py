@@ -0,0 +1,98 @@
+import hmac
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telebot import types
+from core import (
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL
+)
+from .bot_instance import bot
+from typing import Optional
+
+# Максимальный размер апдейта, который принимаем (байт)
+MAX_UPDATE_SIZE = 1_000_000
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Прием апдейтов Telegram: POST с JSON апдейта на WEBHOOK_PATH
+
+    Апдейт ставится в очередь своего чата в bot. Если очередь полна, отвечаем 503 -
+    Telegram (или балансировщик) повторит запрос позже
+    """
+
+    def respond(self, status: int, body: str = '', retry_after: Optional[int] = None) -> None:
+        """
+        Ответ с кодом status и текстом body
+        """
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        """
+        Проверка живости для балансировщика: число апдейтов в очередях
+        """
+        if self.path != '/health':
+            self.respond(404)
+            return
+        self.respond(200, json.dumps({'pending': bot.pending()}))
+
+    def do_POST(self) -> None:
+        """
+        Прием апдейта
+        """
+        if self.path != WEBHOOK_PATH:
+            self.respond(404)
+            return
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+                self.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), WEBHOOK_SECRET):
+            self.respond(403)
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if not 0 < length <= MAX_UPDATE_SIZE:
+            self.respond(413 if length else 400)
+            return
+
+        try:
+            update = types.Update.de_json(self.rfile.read(length).decode('utf-8'))
+        except Exception:
+            logging.warning("Got malformed update")
+            self.respond(400)
+            return
+
+        # Очередь чата полна - не ждем, а просим прислать апдейт позже
+        if not bot.dispatch(update, block=False):
+            self.respond(503, retry_after=1)
+            return
+        self.respond(200)
+
+    def log_message(self, format: str, *args: object) -> None:
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+def serve_webhook(host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT) -> None:
+    """
+    Запуск HTTP-сервера для вебхука (и регистрация вебхука в Telegram, если задан WEBHOOK_URL)
+    """
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+
+    server = ThreadingHTTPServer((host, port), WebhookHandler)
+    server.daemon_threads = True
+    logging.info(f"Serving webhook on {host}:{port}{WEBHOOK_PATH}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
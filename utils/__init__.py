@@ -1,9 +1,12 @@
+from typing import Any
+
 from .database import (
     Base,
     engine
 )
 
 from .database_services import (
+    session_scope,
     add_stage,
     add_stage_name,
     reaction_to_prev_select,
@@ -13,7 +16,46 @@ from .database_services import (
     select_tag_toasts,
     select_random_toasts,
     get_all_generated,
+    get_disliked,
+    get_corpus_version,
+    get_user_tags,
     db_notempty
 )
 
-from .parse_schema import PageParser
\ No newline at end of file
+from .tag_index import tag_index
+
+from .tag_vocabulary import tag_vocabulary
+
+from .tfidf_model import tfidf_model
+
+from .similarity_index import similarity_index
+
+from .seen_cache import seen_cache
+
+from .generated_cache import generated_cache
+
+from .stage_cache import stage_cache
+
+from .markov_services import (
+    get_markov,
+    markov_cache,
+    get_random_model,
+    get_tag_model,
+    get_sentence_fit,
+    build_markov_artifact,
+    preload_markov,
+    ensure_markov_artifact,
+    generate_toast
+)
+
+from .generation_pool import generation_pool
+
+
+def __getattr__(name: str) -> Any:
+    """
+    PageParser нужен только для заливки, поэтому импортируем его (и парсинговые библиотеки) при первом обращении
+    """
+    if name == 'PageParser':
+        from .parse_schema import PageParser
+        return PageParser
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,48 @@
+import os
+from pathlib import Path
+from core import ARTIFACTS_DIR
+from typing import Callable, Any, Optional
+
+# Версия формата артефактов. Меняем, если поменялось содержимое файлов
+ARTIFACT_FORMAT = 1
+
+
+def artifact_path(name: str, version: int, suffix: str) -> Path:
+    """
+    Путь к артефакту name для версии корпуса version
+    """
+    return Path(ARTIFACTS_DIR) / f"{name}.v{ARTIFACT_FORMAT}.{version}.{suffix}"
+
+
+def write_artifact(path: Path, write: Callable[[Any], None], binary: bool = False) -> None:
+    """
+    Атомарная запись артефакта: пишем во временный файл и подменяем им старый,
+    а затем удаляем все прочие версии этого артефакта
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # В имени временного файла pid: артефакт могут одновременно собирать несколько процессов
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'wb' if binary else 'w', encoding=None if binary else 'utf-8') as artifact_file:
+        write(artifact_file)
+    os.replace(tmp_path, path)
+
+    # Старые версии больше не нужны (чужие временные файлы не трогаем)
+    name = path.name.split('.v', 1)[0]
+    for old_path in path.parent.glob(f"{name}.v*"):
+        if old_path != path and old_path.suffix != '.tmp':
+            old_path.unlink(missing_ok=True)
+
+
+def artifact_version(path: Path) -> int:
+    """
+    Версия корпуса, для которой собран артефакт
+    """
+    return int(path.name.split('.')[2])
+
+
+def find_artifact(name: str, suffix: str) -> Optional[Path]:
+    """
+    Путь к сохраненному артефакту name текущего формата любой версии корпуса (None, если его нет)
+    """
+    paths = sorted(Path(ARTIFACTS_DIR).glob(f"{name}.v{ARTIFACT_FORMAT}.*.{suffix}"), key=artifact_version)
+    return paths[-1] if paths else None
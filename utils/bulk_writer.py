@@ -0,0 +1,115 @@
+from sqlalchemy import insert, select, text
+from sqlalchemy.sql import func
+from .database import engine
+from .models import (
+    Toast,
+    Tag,
+    ToastToTag
+)
+from .tag_index import tag_index
+from .tag_vocabulary import tag_vocabulary
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+# Настройки sqlite на время заливки: без fsync на каждую страницу и с большим кэшем
+INGEST_PRAGMAS = {
+    'synchronous': 'OFF',
+    'temp_store': 'MEMORY',
+    'cache_size': '-200000',
+}
+
+
+class BulkWriter:
+    """
+    Пакетная запись тостов, тегов и связей тост-тег в БД одной транзакцией
+
+    id тостов назначаются в памяти, строки пишутся через executemany пачками по batch_size.
+    Новые теги вставляем через INSERT OR IGNORE, как tag_vocabulary.resolve: тот же тег мог уже добавить бот,
+    пока идет заливка. Поэтому связи тост-тег до записи пачки держим с названием тега, а id новых тегов
+    перечитываем из БД. В общий словарь тегов новые теги попадают после коммита
+    """
+
+    def __init__(self, batch_size: int = 10000):
+        self.new_tags: Dict[str, int] = {}
+        self.batch_size: int = batch_size
+        self.connection: Any = None
+        self.transaction: Any = None
+        self.old_pragmas: Dict[str, Any] = {}
+        self.next_toast_id: int = 0
+        self.toasts: List[Dict[str, Any]] = []
+        # Новые теги, которых еще нет в БД, и связи (id тоста, название тега) текущей пачки
+        self.tags: Set[str] = set()
+        self.links: List[Tuple[int, str]] = []
+
+    def __enter__(self) -> 'BulkWriter':
+        self.connection = engine.connect()
+
+        # Прагмы нельзя менять внутри транзакции, поэтому ставим их до нее
+        if engine.dialect.name == 'sqlite':
+            for pragma, value in INGEST_PRAGMAS.items():
+                self.old_pragmas[pragma] = self.connection.execute(text(f"PRAGMA {pragma}")).scalar()
+                self.connection.execute(text(f"PRAGMA {pragma} = {value}"))
+            self.connection.commit()
+
+        tag_vocabulary.load()
+        self.transaction = self.connection.begin()
+        self.next_toast_id = (self.connection.execute(func.max(Toast.id).select()).scalar() or 0) + 1
+        return self
+
+    def add(self, toast_text: str, tags: Iterable[str]) -> int:
+        """
+        Добавление тоста и его тегов. Возвращает id тоста
+        """
+        toast_id = self.next_toast_id
+        self.next_toast_id += 1
+        self.toasts.append({'id': toast_id, 'toast_text': toast_text})
+
+        for tag in set(tags):
+            # Если тег новый, его id узнаем при записи пачки
+            if tag_vocabulary.get(tag) is None and tag not in self.new_tags:
+                self.tags.add(tag)
+            self.links.append((toast_id, tag))
+
+        if len(self.links) >= self.batch_size:
+            self.flush()
+        return toast_id
+
+    def flush(self) -> None:
+        """
+        Запись накопленных строк (без коммита)
+        """
+        if self.toasts:
+            self.connection.execute(insert(Toast), self.toasts)
+            self.toasts.clear()
+
+        # Новые теги: вставляем, пропуская уже существующие, и берем их id из БД
+        # (кусками, чтобы не упереться в лимит параметров sqlite)
+        if self.tags:
+            names = list(self.tags)
+            self.connection.execute(insert(Tag).prefix_with('OR IGNORE'), [{'tag_name': tag} for tag in names])
+            for i in range(0, len(names), 900):
+                self.new_tags.update({tag_name: tag_id for tag_id, tag_name in self.connection.execute(
+                    select(Tag.id, Tag.tag_name).where(Tag.tag_name.in_(names[i:i + 900])))})
+            self.tags.clear()
+
+        if self.links:
+            self.connection.execute(insert(ToastToTag), [
+                {'toast_id': toast_id, 'tag_id': self.new_tags.get(tag) or tag_vocabulary.get(tag)}
+                for toast_id, tag in self.links])
+            self.links.clear()
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        try:
+            if exc_type is None:
+                self.flush()
+                self.transaction.commit()
+            else:
+                self.transaction.rollback()
+        finally:
+            for pragma, value in self.old_pragmas.items():
+                self.connection.execute(text(f"PRAGMA {pragma} = {value}"))
+            self.connection.close()
+
+        # Подтягиваем записанное в словарь и индекс тегов
+        if exc_type is None:
+            tag_vocabulary.publish(self.new_tags)
+            tag_index.sync()
@@ -0,0 +1,183 @@
+"""
+Чистка таблиц, которые только растут: stage_to_user, user_tags и toast_to_user
+
+Бот читает из них только последнюю запись юзера (стадию, теги, тост для реакции), дизлайки
+и записи, которые еще не попали в снимок карты просмотренных (seen_bitmaps). Все остальное
+переносится в архив или удаляется - по COMPACTION_POLICY. Если включена история стадий (STAGE_HISTORY),
+stage_to_user - это она и есть, и ее не трогаем. Чистка идет пачками по диапазонам id,
+каждая пачка - своя короткая транзакция, так что бот между ними спокойно пишет в БД.
+
+Один полный проход вручную:
+
+    python -m utils.compaction
+"""
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from sqlalchemy import bindparam, text
+from core import (
+    COMPACTION_POLICY,
+    COMPACTION_ARCHIVE,
+    COMPACTION_BATCH,
+    COMPACTION_PAUSE,
+    COMPACTION_INTERVAL,
+    STAGE_HISTORY
+)
+from .database import engine
+from typing import Any, Dict, Optional, Tuple
+
+# Какие строки таблицы больше не нужны боту (t - сама таблица)
+OBSOLETE: Dict[str, str] = {
+    # Не последняя стадия юзера
+    'stage_to_user': "t.id < (SELECT max(latest.id) FROM stage_to_user AS latest WHERE latest.chat_id = t.chat_id)",
+    # Не последние теги юзера
+    'user_tags': "t.id < (SELECT max(latest.id) FROM user_tags AS latest WHERE latest.chat_id = t.chat_id)",
+    # Просмотренный (и не дизлайкнутый) тост из базы, который уже есть в снимке карты просмотренных.
+    # Сгенерированные тосты пока храним - по ним проверяем, что не повторяемся
+    'toast_to_user': "t.toast_id IS NOT NULL AND t.user_like = 1"
+                     " AND t.id < (SELECT max(latest.id) FROM toast_to_user AS latest WHERE latest.chat_id = t.chat_id)"
+                     " AND t.id <= (SELECT last_record_id FROM seen_bitmaps WHERE seen_bitmaps.chat_id = t.chat_id)",
+}
+
+# История стадий нужна тому, кто ее включил, а не боту - ее не чистим
+if STAGE_HISTORY:
+    del OBSOLETE['stage_to_user']
+
+
+class Compactor:
+    """
+    Пошаговая чистка: за шаг обрабатываем по одному диапазону из batch id в каждой таблице
+
+    Запоминаем, докуда дошли в каждой таблице; когда все таблицы пройдены до конца, проход закончен
+    и следующий начинается с начала. В фоне шаги идут с паузой pause, а проходы - раз в interval секунд
+    """
+
+    def __init__(self, policy: str, archive: str, batch: int, pause: float, interval: float):
+        self.policy: str = policy
+        self.archive: Path = Path(archive)
+        self.batch: int = batch
+        self.pause: float = pause
+        self.interval: float = interval
+        self.cursors: Dict[str, int] = {table: 0 for table in OBSOLETE}
+        self.done: Dict[str, bool] = {table: False for table in OBSOLETE}
+        self.lock: threading.Lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def compact_range(self, connection: Any, table: str) -> Tuple[int, Optional[int]]:
+        """
+        Чистка следующего диапазона id таблицы table
+
+        Возвращает число убранных строк и новое положение курсора (None - таблица пройдена до конца).
+        Сам курсор не двигаем: это делает step после коммита, чтобы диапазон из упавшей транзакции не пропустить
+        """
+        start = self.cursors[table]
+        max_id = connection.execute(text(f"SELECT max(id) FROM {table}")).scalar() or 0
+        if start >= max_id:
+            return 0, None
+        end = start + self.batch
+
+        rows = connection.execute(
+            text(f"SELECT t.* FROM {table} AS t WHERE t.id > :start AND t.id <= :end AND {OBSOLETE[table]}"),
+            {'start': start, 'end': end}
+        ).mappings().all()
+        if not rows:
+            return 0, end
+
+        # Сначала архив, потом удаление: если транзакция не пройдет, строка попадет в архив повторно, но не потеряется
+        if self.policy == 'archive':
+            self.archive.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.archive, 'a', encoding='utf-8') as archive_file:
+                for row in rows:
+                    archive_file.write(json.dumps({'table': table, **row}, ensure_ascii=False) + '\n')
+
+        # Удаляем кусками, чтобы не упереться в лимит параметров sqlite (пачка может быть больше 900 id)
+        delete = text(f"DELETE FROM {table} WHERE id IN :ids").bindparams(bindparam('ids', expanding=True))
+        ids = [row['id'] for row in rows]
+        for i in range(0, len(ids), 900):
+            connection.execute(delete, {'ids': ids[i:i + 900]})
+        return len(rows), end
+
+    def step(self, bind: Any = engine) -> int:
+        """
+        Один шаг чистки во всех таблицах, которые еще не пройдены в этом проходе. Возвращает число убранных строк
+        """
+        with self.lock:
+            removed = 0
+            for table in OBSOLETE:
+                if not self.done[table]:
+                    with bind.begin() as connection:
+                        table_removed, cursor = self.compact_range(connection, table)
+                    removed += table_removed
+                    if cursor is None:
+                        self.cursors[table] = 0
+                        self.done[table] = True
+                    else:
+                        self.cursors[table] = cursor
+            return removed
+
+    def finished(self) -> bool:
+        """
+        Закончен ли проход (и если да - начинаем следующий)
+        """
+        with self.lock:
+            if not all(self.done.values()):
+                return False
+            self.done = {table: False for table in OBSOLETE}
+            return True
+
+    def compact(self, bind: Any = engine) -> int:
+        """
+        Полный проход по всем таблицам. Возвращает число убранных строк
+        """
+        removed = 0
+        while True:
+            removed += self.step(bind)
+            if self.finished():
+                return removed
+
+    def run(self) -> None:
+        """
+        Чистка в фоне, пока жив процесс
+        """
+        removed = 0
+        while True:
+            try:
+                removed += self.step()
+            except Exception:
+                logging.exception("Compaction step failed")
+
+            if self.finished():
+                logging.info(f"Compaction pass done, {removed} rows {'archived' if self.policy == 'archive' else 'dropped'}")
+                removed = 0
+                time.sleep(self.interval)
+            else:
+                time.sleep(self.pause)
+
+    def start(self) -> None:
+        """
+        Запуск фоновой чистки (если она включена и еще не запущена)
+        """
+        if self.policy == 'off' or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name='compaction', daemon=True)
+        self.thread.start()
+
+
+# Экземпляр на весь процесс
+compactor = Compactor(COMPACTION_POLICY, COMPACTION_ARCHIVE, COMPACTION_BATCH, COMPACTION_PAUSE, COMPACTION_INTERVAL)
+
+
+def main() -> None:
+    if compactor.policy == 'off':
+        print("COMPACTION_POLICY is off")
+        return
+    start = time.perf_counter()
+    removed = compactor.compact()
+    print(f"{removed} rows {'archived' if compactor.policy == 'archive' else 'dropped'} "
+          f"in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
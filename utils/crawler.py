@@ -0,0 +1,161 @@
+import logging
+import random
+import threading
+import time
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlparse
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from core import (
+    CRAWL_WORKERS,
+    CRAWL_PER_HOST,
+    CRAWL_DELAY,
+    CRAWL_MAX_ATTEMPTS,
+    CRAWL_BACKOFF,
+    CRAWL_TIMEOUT
+)
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple
+)
+
+
+class Task(NamedTuple):
+    """
+    Страница в очереди обхода
+
+    key - порядок страницы в итоговом списке (например, (номер раздела, номер страницы))
+    handler - функция handler(task, soup), которая возвращает найденные на странице данные и новые задачи
+    meta - все, что нужно handler (например, тег раздела)
+    """
+    key: Tuple[int, ...]
+    url: str
+    handler: Callable[['Task', Any], Tuple[List[Any], List['Task']]]
+    meta: Any = None
+
+
+class Crawler:
+    """
+    Обход сайта: очередь страниц, общий пул HTTP-соединений, ограничение одновременных запросов
+    и пауза между запросами к одному хосту, повторы с экспоненциальной задержкой
+    """
+
+    def __init__(self, user_agent: Optional[Callable[[], str]] = None, workers: int = CRAWL_WORKERS,
+                 per_host: int = CRAWL_PER_HOST, delay: float = CRAWL_DELAY,
+                 max_attempts: int = CRAWL_MAX_ATTEMPTS, backoff: float = CRAWL_BACKOFF,
+                 timeout: float = CRAWL_TIMEOUT):
+        self.user_agent: Optional[Callable[[], str]] = user_agent
+        self.workers: int = workers
+        self.per_host: int = per_host
+        self.delay: float = delay
+        self.max_attempts: int = max_attempts
+        self.backoff: float = backoff
+        self.timeout: float = timeout
+
+        self.session: Any = requests.session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.lock: threading.Lock = threading.Lock()
+        self.host_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self.host_next_time: Dict[str, float] = {}
+
+    def wait_for_host(self, host: str) -> threading.BoundedSemaphore:
+        """
+        Ждем своей очереди к хосту (соблюдая паузу между запросами) и возвращаем его семафор
+        """
+        with self.lock:
+            slots = self.host_slots.setdefault(host, threading.BoundedSemaphore(self.per_host))
+        slots.acquire()
+
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.host_next_time.get(host, now))
+            self.host_next_time[host] = start + self.delay
+        time.sleep(start - now)
+        return slots
+
+    def fetch(self, url: str) -> Optional[str]:
+        """
+        Текст страницы по url или None, если все попытки не удались
+        """
+        host = urlparse(url).netloc
+        for attempt in range(self.max_attempts):
+            slots = self.wait_for_host(host)
+            try:
+                headers = {'User-Agent': self.user_agent()} if self.user_agent else {}
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+                # На 429 и 5xx есть смысл попробовать еще раз, на остальные ошибки - нет
+                if response.status_code == 429 or response.status_code >= 500:
+                    raise requests.HTTPError(f"{response.status_code} for {url}")
+                if response.status_code >= 400:
+                    logging.warning(f"Skipping {url}: {response.status_code}")
+                    return None
+                return response.text
+            except Exception as error:
+                logging.warning(f"Attempt {attempt + 1} for {url} failed: {error}")
+            finally:
+                slots.release()
+
+            # Экспоненциальная задержка со случайной добавкой
+            if attempt + 1 < self.max_attempts:
+                time.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+
+        logging.error(f"Giving up on {url} after {self.max_attempts} attempts")
+        return None
+
+    def get_soup(self, url: str) -> Optional[Any]:
+        """
+        Получение "супа" страницы по url (None, если страницу скачать не удалось)
+        """
+        page = self.fetch(url)
+        return BeautifulSoup(page, 'html.parser') if page is not None else None
+
+    def run_task(self, task: Task) -> Tuple[List[Any], List[Task]]:
+        """
+        Скачивание страницы и ее разбор
+        """
+        soup = self.get_soup(task.url)
+        if soup is None:
+            return [], []
+        try:
+            return task.handler(task, soup)
+        except Exception:
+            logging.exception(f"Can't parse {task.url}")
+            return [], []
+
+    def crawl(self, tasks: List[Task]) -> List[Any]:
+        """
+        Обход всех страниц, начиная с tasks. Возвращает данные со всех страниц в порядке ключей задач
+        """
+        frontier = deque(tasks)
+        visited = {task.url for task in tasks}
+        results: Dict[Tuple[int, ...], List[Any]] = {}
+        running: Dict[Any, Task] = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool, tqdm() as progress:
+            while frontier or running:
+                while frontier and len(running) < self.workers:
+                    task = frontier.popleft()
+                    running[pool.submit(self.run_task, task)] = task
+
+                done = wait(running, return_when=FIRST_COMPLETED)[0]
+                for future in done:
+                    items, new_tasks = future.result()
+                    results[running.pop(future).key] = items
+                    for new_task in new_tasks:
+                        if new_task.url not in visited:
+                            visited.add(new_task.url)
+                            frontier.append(new_task)
+                    progress.update()
+
+        return [item for key in sorted(results) for item in results[key]]
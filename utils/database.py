@@ -1,12 +1,34 @@
 from sqlalchemy import (
-    create_engine)
+    create_engine,
+    event)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from core import DATABASE
+from core import DATABASE, SQLITE_WAL, SQLITE_BUSY_TIMEOUT
+from typing import Any
 
 # Создаем sqlite engine
 engine = create_engine(DATABASE)
 
+
+@event.listens_for(engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+    """
+    Настройки каждого нового соединения с sqlite: ожидание блокировки записи и журнал WAL
+
+    pysqlite открывает транзакцию только перед первой записью, так что писатель ждет блокировку
+    до busy_timeout, а не падает сразу
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT}")
+    if SQLITE_WAL:
+        cursor.execute("PRAGMA journal_mode = WAL")
+        # В режиме WAL synchronous = NORMAL не грозит порчей БД, а fsync на каждый коммит не нужен
+        cursor.execute("PRAGMA synchronous = NORMAL")
+    cursor.close()
+
+
 # Создаем экземпляр БД (класс DeclarativeMeta)
 Base = declarative_base()
 
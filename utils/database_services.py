@@ -1,35 +1,46 @@
 import json
+import random
+import numpy as np
+from contextlib import contextmanager
 from .database import SessionLocal
 from .models import (
+    GeneratedToast,
     Toast,
     Stages,
-    StageToUser,
     ToastToUser,
-    Tag,
     ToastToTag,
     UserTags
 )
 from sqlalchemy import (
+    event,
+    insert,
     update,
-    and_,
-    or_
+    and_
 )
 from sqlalchemy.sql import func
-from .text_services import (
-    preprocess_text,
-    create_tfidf,
-    get_top_tf_idf_words
-)
+from core import TAG_BACKEND
+from .tag_index import tag_index
+from .tag_vocabulary import tag_vocabulary
+from .similarity_index import similarity_index
+from .seen_cache import seen_cache
+from .generated_cache import generated_cache, toast_hash
+from .stage_cache import stage_cache
+from .tfidf_model import tfidf_model
+from .text_services import preprocess_text
 from typing import (
     Any,
+    Iterable,
+    Iterator,
     List,
-    Dict,
     Tuple,
     Set,
     Union,
     Optional
 )
 
+# Сколько раз пробуем угадать непросмотренный тост, прежде чем перебирать все непросмотренные
+RANDOM_TRIES = 16
+
 
 def create_session() -> Any:
     """
@@ -39,277 +50,345 @@ def create_session() -> Any:
     return session
 
 
-def db_notempty() -> int:
+@contextmanager
+def session_scope(session: Any = None) -> Iterator[Any]:
     """
-    Проверка, пустая ли наша БД
+    Единица работы: сессия, которая коммитится один раз в конце (и откатывается при ошибке)
+
+    Если передана уже открытая сессия, просто отдаем ее - коммитит тот, кто ее открыл.
+    Так обработчик апдейта открывает одну транзакцию на весь апдейт, а функции ниже
+    без переданной сессии по-прежнему работают каждая в своей
     """
+    if session is not None:
+        yield session
+        return
+
     session = create_session()
-    response = len(session.query(Toast).all())
-    session.close()
-    return response
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
 
 
-def add_toast(tags: List[str], toast_text: str, all_tags: Dict[str, int]) -> Tuple[int, Dict[str, int]]:
+def db_notempty(session: Any = None) -> bool:
     """
-    Добавление тоста и его тегов в БД
+    Проверка, пустая ли наша БД
     """
-    session = create_session()
+    with session_scope(session) as session:
+        return session.query(session.query(Toast.id).exists()).scalar()
 
-    # Добавляем тост в БД
-    toast = Toast(
-        toast_text=toast_text
-    )
-    session.add(toast)
-    session.commit()
 
-    for tag in tags:
-        # Если такой тег уже был, достаем его значение из словаря
-        if tag in all_tags:
-            tag_id = all_tags[tag]
-
-        # Если тег новый, добавляем в БД и в словарь
-        else:
-            new_tag = Tag(tag_name=tag)
-            session.add(new_tag)
-            session.commit()
-            tag_id = new_tag.id
-            all_tags[tag] = tag_id
-
-        # Добавляем связь тост-тег в таблицу
-        toast2tag = ToastToTag(
-            toast_id=toast.id,
-            tag_id=tag_id
+def add_toast(tags: Iterable[str], toast_text: str, session: Any = None) -> int:
+    """
+    Добавление тоста и его тегов в БД. Возвращает id тоста
+    """
+    with session_scope(session) as session:
+        # Добавляем тост в БД (flush - чтобы получить id)
+        toast = Toast(
+            toast_text=toast_text
         )
-        session.add(toast2tag)
-        session.commit()
+        session.add(toast)
+        session.flush()
+
+        # id тегов берем из общего словаря, новые теги создаются там же
+        tag_ids = tag_vocabulary.resolve(tags, session)
+
+        # Добавляем связи тост-тег в таблицу одним запросом
+        if tag_ids:
+            session.execute(insert(ToastToTag), [{'toast_id': toast.id, 'tag_id': tag_id}
+                                                 for tag_id in tag_ids.values()])
+
+        # Добавляем тост в индекс тегов, только когда он точно попал в БД
+        toast_id = toast.id
+        event.listen(session, 'after_commit', lambda _: tag_index.add(toast_id, tag_ids), once=True)
 
-    session.close()
-    return toast.id, all_tags
+    return toast_id
 
 
-def add_stage_name(stage: str) -> None:
+def add_stage_name(stage: str, session: Any = None) -> None:
     """
     Добавление названия "стадии" бота в БД
     """
-    session = create_session()
-    stage_class = Stages(stage_name=stage)
-    session.add(stage_class)
-    session.commit()
-    session.close()
+    with session_scope(session) as session:
+        stage_class = Stages(stage_name=stage)
+        session.add(stage_class)
 
 
-def get_last_stage(chat_id: int, return_id: Optional[bool] = False) -> str:
+def get_last_stage(chat_id: int, return_id: Optional[bool] = False,
+                   session: Any = None) -> Optional[Union[str, int]]:
     """
-    Последняя стадия, на которой был пользователь с chat_id
+    Последняя стадия, на которой был пользователь с chat_id (None, если он у нас впервые)
     return_id - если True, возвращаем id стадии; если Fasle, - название
     """
-    session = create_session()
-    stage_name = session.query(Stages.id if return_id else Stages.stage_name) \
-        .join(StageToUser) \
-        .filter(StageToUser.chat_id == chat_id) \
-        .order_by(StageToUser.id.desc()) \
-        .first()[0]
-    session.close()
-    return stage_name
+    stage_id = stage_cache.get(chat_id, session)
+    if stage_id is None or return_id:
+        return stage_id
+    return stage_cache.stage_name(stage_id)
 
 
-def add_stage(chat_id: int, stage: Optional[str] = None, stage_id: Optional[int] = None) -> None:
+def add_stage(chat_id: int, stage: Optional[str] = None, stage_id: Optional[int] = None,
+              session: Any = None) -> None:
     """
-    Добавление записи о пользователе на стадии по названию стадии или по id стадии
+    Запись текущей стадии пользователя по названию стадии или по id стадии
     stage - название стадии
     stage_id - id стадии
     """
-    session = create_session()
     if not stage_id:
-        stage_id = int(session.query(Stages.id).filter(
-            Stages.stage_name == stage).one()[0])
-    stage2user = StageToUser(stage_id=stage_id, chat_id=chat_id)
-    session.add(stage2user)
-    session.commit()
-    session.close()
+        stage_id = stage_cache.stage_id(stage)
+
+    with session_scope(session) as session:
+        stage_cache.set(session, chat_id, stage_id)
 
 
-def reaction_to_prev_select(chat_id: int) -> None:
+def reaction_to_prev_select(chat_id: int, session: Any = None) -> None:
     """
     Изменение реакции на последний выбранный тост на негативную
     """
-    session = create_session()
-    session.execute(
-        update(ToastToUser)
-        .where(ToastToUser.id == session.query(func.max(ToastToUser.id))
-               .filter(ToastToUser.chat_id == chat_id)
-               .group_by(ToastToUser.chat_id).subquery()
-               ).values(user_like=False)
-    )
-    session.commit()
-    session.close()
+    with session_scope(session) as session:
+        session.execute(
+            update(ToastToUser)
+            .where(ToastToUser.id == session.query(func.max(ToastToUser.id))
+                   .filter(ToastToUser.chat_id == chat_id)
+                   .group_by(ToastToUser.chat_id).subquery()
+                   ).values(user_like=False)
+        )
 
 
-def reaction_to_prev_generate(chat_id: int) -> None:
+def reaction_to_prev_generate(chat_id: int, session: Any = None) -> None:
     """
     Изменение реакции на последний сгенерированный тост на положительную
     """
-    session = create_session()
-
-    # Меняем реакцию пользователя в БД и получаем текст тоста
-    gen_toast = session.execute(
-        update(ToastToUser)
-        .where(
-            ToastToUser.id == session.query(func.max(ToastToUser.id))
-            .filter(ToastToUser.chat_id == chat_id)
-            .group_by(ToastToUser.chat_id).subquery()
-        ).values(user_like=True)
-        .returning(ToastToUser.generated_toast)
-    ).fetchone()[0]
-
-    # Составляем словарь всех существующих тегов
-    all_tags = {tag[1]: int(tag[0])
-                for tag in session.query(Tag.id, Tag.tag_name).all()}
-
-    session.close()
-
-    # Препроцессинг и tf-idf тоста, чтобы получить все теги
-    toast_preprocessed = [" ".join(preprocess_text(gen_toast))]
-    toasts_tfidf, feature_names = create_tfidf(toast_preprocessed)
-    toast_vector = toasts_tfidf[0, :]
-    tags = set(get_top_tf_idf_words(toast_vector, feature_names, 10))
-
-    # Добавляем тост и теги в БД
-    toast_id = add_toast(tags, gen_toast, all_tags)[0]
-
-    # Меняем в таблице тост-пользователь текст тоста на id
-    session = create_session()
-    session.execute(
-        update(ToastToUser)
-        .where(ToastToUser.id == session.query(func.max(ToastToUser.id))
-               .filter(ToastToUser.chat_id == chat_id)
-               .group_by(ToastToUser.chat_id)
-               .subquery()
-               ).values(toast_id=toast_id, generated_toast=None)
-    )
-    session.commit()
-    session.close()
-
-
-def filter_unseen(session: Any, chat_id: int) -> Any:
+    with session_scope(session) as session:
+        # Меняем реакцию пользователя в БД и получаем хэш тоста
+        record = session.execute(
+            update(ToastToUser)
+            .where(
+                ToastToUser.id == session.query(func.max(ToastToUser.id))
+                .filter(ToastToUser.chat_id == chat_id)
+                .group_by(ToastToUser.chat_id).subquery()
+            ).values(user_like=True)
+            .returning(ToastToUser.generated_id)
+        ).fetchone()
+
+        # Юзеру еще не отправляли ни одного тоста (например, по его тегам ничего не нашлось)
+        # или последний тост был из базы (не получилось сгенерировать новый) - добавлять нечего
+        if record is None or record[0] is None:
+            return
+        generated_id = record[0]
+        gen_toast = session.get(GeneratedToast, generated_id).toast_text
+
+        # Препроцессинг и tf-idf тоста по модели всего корпуса, чтобы получить все теги
+        tags = set(tfidf_model.top_words(" ".join(preprocess_text(gen_toast)), 10))
+
+        # Добавляем тост и теги в БД
+        toast_id = add_toast(tags, gen_toast, session)
+
+        # Меняем в таблице тост-пользователь текст тоста на id
+        record_id = session.execute(
+            update(ToastToUser)
+            .where(ToastToUser.id == session.query(func.max(ToastToUser.id))
+                   .filter(ToastToUser.chat_id == chat_id)
+                   .group_by(ToastToUser.chat_id)
+                   .subquery()
+                   ).values(toast_id=toast_id, generated_id=None)
+            .returning(ToastToUser.id)
+        ).fetchone()[0]
+
+        # Теперь юзер "видел" этот тост из базы
+        seen_cache.add(session, chat_id, toast_id, record_id)
+
+
+def filter_not_dislike(session: Any, chat_id: int) -> Any:
     """
-    Условие возвращает тосты, который пользователь не видел
+    Условие возвращает тосты, которым пользователь не поставил дизлайк
     """
     return Toast.id \
         .not_in(
             session.query(ToastToUser.toast_id)
-                .filter(and_(ToastToUser.chat_id == chat_id, ToastToUser.toast_id != None))
+                .filter(and_(ToastToUser.chat_id == chat_id, ToastToUser.toast_id != None,
+                             ToastToUser.user_like == False))
             .subquery()
         )
 
 
-def filter_not_dislike(chat_id: int) -> Any:
+def get_disliked(chat_id: int, session: Any = None) -> Set[int]:
     """
-    Условие возвращает тосты, которым пользователь не поставил дизлайк
+    Множество id тостов, которым пользователь поставил дизлайк
     """
-    return and_(ToastToUser.chat_id == chat_id,
-                or_(ToastToUser.user_like == None, ToastToUser.user_like == True))
+    with session_scope(session) as session:
+        disliked = session.query(ToastToUser.toast_id) \
+            .filter(and_(ToastToUser.chat_id == chat_id, ToastToUser.toast_id != None,
+                         ToastToUser.user_like == False)).all()
+    return {toast_id[0] for toast_id in disliked}
 
 
-def select_random_toasts(chat_id: int, all_toasts: Optional[bool] = False) -> Union[Tuple[str, int], List[str]]:
+def get_corpus_version(session: Any = None) -> int:
     """
-    Выбор тостов без тегов - либо 1 рандомный, либо все без дизлайка от юзера (для генерации)
-    all_toasts - True, если нужны все тосты; False, если нужен один
+    Версия корпуса тостов - id последнего добавленного тоста (меняется только в add_toast)
     """
-    session = create_session()
-    toasts = session.query(Toast.toast_text, Toast.id).join(
-        ToastToUser, ToastToUser.toast_id == Toast.id, isouter=True)
+    with session_scope(session) as session:
+        version = session.query(func.max(Toast.id)).scalar()
+    return version or 0
 
-    # Если нам не нужны все тосты, возвращаем 1 рандомный из тех, что юзер не видел
-    if not all_toasts:
-        response = toasts.filter(filter_unseen(
-            session, chat_id)).order_by(func.random()).first()
 
-    # Возвращаем все, которые юзер не дизлайкал
-    else:
-        response = [text[0]
-                    for text in toasts.filter(filter_not_dislike(chat_id)).all()]
+def select_random_toasts(chat_id: int, all_toasts: Optional[bool] = False,
+                         session: Any = None) -> Union[Tuple[str, int], List[str]]:
+    """
+    Выбор тостов без тегов - либо 1 рандомный, либо все без дизлайка от юзера (для генерации)
+    all_toasts - True, если нужны все тосты; False, если нужен один
+    """
+    with session_scope(session) as session:
+        toasts = session.query(Toast.toast_text, Toast.id)
+
+        # Если нам не нужны все тосты, возвращаем 1 рандомный из тех, что юзер не видел
+        if not all_toasts:
+            max_id = session.query(func.max(Toast.id)).scalar() or 0
+            seen = seen_cache.get(chat_id, session)
+            response = None
+
+            # Берем случайный id и проверяем по карте просмотренных - обычно хватает одной-двух попыток
+            for _ in range(RANDOM_TRIES if max_id else 0):
+                toast_id = random.randint(1, max_id)
+                if toast_id not in seen:
+                    response = toasts.filter(Toast.id == toast_id).first()
+                    if response:
+                        break
+
+            # Юзер видел почти все - выбираем из явного списка непросмотренных (в id могут быть пропуски)
+            else:
+                unseen = seen.unseen(max_id)
+                while response is None and len(unseen):
+                    i = random.randrange(len(unseen))
+                    response = toasts.filter(Toast.id == int(unseen[i])).first()
+                    unseen = np.delete(unseen, i)
+
+        # Возвращаем все, которые юзер не дизлайкал
+        else:
+            response = [text[0]
+                        for text in toasts.filter(filter_not_dislike(session, chat_id)).all()]
 
-    session.close()
     return response
 
 
-def select_tag_toasts(chat_id: int, all_toasts: Optional[bool] = False, message: Optional[str] = None) -> Union[None, List[str], Tuple[str, int]]:
+def select_all_toasts(session: Any = None) -> List[str]:
     """
-    Выбор тостов с тегами - либо 1 наиболее подходящий, либо все подходящие без дизлайка от юзера (для генерации)
-    all_toasts - True, если нужны все тосты; False, если нужен один
-    message - сообщение с тегами от пользователя. Если None, находим последние теги от пользователя
+    Тексты всех тостов в базе
     """
-    session = create_session()
+    with session_scope(session) as session:
+        return [text[0] for text in session.query(Toast.toast_text).all()]
 
-    # Находим последние теги от пользователя
-    if not message:
-        tags = json.loads(
-            session.query(UserTags.user_tags)
-            .filter(UserTags.chat_id == chat_id)
-            .order_by(UserTags.id.desc())
-            .first()[0]
-        )
 
-    # Препроцессим теги и добавляем из в таблицу пользователь-теги в виде stringified list
-    else:
-        tags = preprocess_text(message)
-        user_tags = UserTags(
-            chat_id=chat_id,
-            user_tags=json.dumps(tags, ensure_ascii=False)
-        )
-        session.add(user_tags)
-        session.commit()
+def select_texts(session: Any, toast_ids: List[int]) -> List[str]:
+    """
+    Тексты тостов по списку id (запрашиваем кусками, чтобы не упереться в лимит параметров sqlite)
+    """
+    texts = []
+    for i in range(0, len(toast_ids), 900):
+        texts.extend(text[0] for text in session.query(Toast.toast_text)
+                     .filter(Toast.id.in_(toast_ids[i:i + 900])).all())
+    return texts
+
 
-    # Находим наиболее подходящие тосты (по убыванию совпадающих тегов)
-    toasts = session.query(Toast.toast_text, Toast.id) \
-        .join(ToastToTag, ToastToTag.toast_id == Toast.id) \
-        .join(Tag, Tag.id == ToastToTag.tag_id) \
-        .filter(and_(Tag.tag_name.in_(tags),
-                     filter_not_dislike(chat_id) if all_toasts else filter_unseen(session, chat_id))
-                ).group_by(Toast.id) \
-        .order_by(func.count(Tag.tag_name).desc()).all()
+def get_user_tags(chat_id: int, message: Optional[str] = None, session: Any = None) -> List[str]:
+    """
+    Теги пользователя - либо из нового сообщения, либо последние, которые он вводил
+    message - сообщение с тегами от пользователя. Если None, находим последние теги от пользователя
+    """
+    with session_scope(session) as session:
+        # Находим последние теги от пользователя
+        if not message:
+            tags = json.loads(
+                session.query(UserTags.user_tags)
+                .filter(UserTags.chat_id == chat_id)
+                .order_by(UserTags.id.desc())
+                .first()[0]
+            )
+
+        # Препроцессим теги и добавляем из в таблицу пользователь-теги в виде stringified list
+        else:
+            tags = preprocess_text(message)
+            user_tags = UserTags(
+                chat_id=chat_id,
+                user_tags=json.dumps(tags, ensure_ascii=False)
+            )
+            session.add(user_tags)
 
-    # Если пусто, возвращаем None
-    if not len(toasts):
-        response = None
+    return tags
 
-    # Если нужен 1 тост, возвращаем самый совпадающий по тегам
-    elif not all_toasts:
-        response = toasts[0]
 
-    # Иначе возвращаем список всех тостов
-    else:
-        response = [text[0] for text in toasts]
+def select_tag_toasts(chat_id: int, all_toasts: Optional[bool] = False, message: Optional[str] = None,
+                      tags: Optional[List[str]] = None,
+                      session: Any = None) -> Union[None, List[str], Tuple[str, int]]:
+    """
+    Выбор тостов с тегами - либо 1 наиболее подходящий, либо все подходящие без дизлайка от юзера (для генерации)
+    all_toasts - True, если нужны все тосты; False, если нужен один
+    message - сообщение с тегами от пользователя. Если None, находим последние теги от пользователя
+    tags - уже готовые теги пользователя (тогда message не нужен)
+    """
+    with session_scope(session) as session:
+        if tags is None:
+            tags = get_user_tags(chat_id=chat_id, message=message, session=session)
+
+        # Находим подходящие тосты: по убыванию косинусной близости к тегам или по убыванию совпадающих тегов
+        if TAG_BACKEND == 'similarity':
+            similarity_index.sync()
+            toast_ids = similarity_index.search(tags)
+        else:
+            tag_index.sync()
+            toast_ids = tag_index.search(tags)
+
+        # Если нужен 1 тост, возвращаем самый совпадающий по тегам из тех, что юзер не видел
+        if not all_toasts:
+            seen = seen_cache.get(chat_id, session)
+            toast_id = next(
+                (toast_id for toast_id in toast_ids if toast_id not in seen), None)
+            response = session.query(Toast.toast_text, Toast.id) \
+                .filter(Toast.id == toast_id).first() if toast_id else None
+
+        # Иначе возвращаем список всех тостов без дизлайка (или None, если пусто)
+        else:
+            disliked = get_disliked(chat_id=chat_id, session=session)
+            response = select_texts(session, [toast_id for toast_id in toast_ids
+                                              if toast_id not in disliked]) or None
 
-    session.close()
     return response
 
 
-def add_toast_seen(chat_id: int, gen_toast: Optional[str] = None, toast_id: Optional[int] = None) -> None:
+def add_toast_seen(chat_id: int, gen_toast: Optional[str] = None, toast_id: Optional[int] = None,
+                   session: Any = None) -> None:
     """
     Добавление тоста в "просмотренные" для пользователя 
     gen_toast - тут не пусто, если бот прислал сгенерированный тост
     toast_id - тут не пусто, если бот прислал тост из базы
     """
-    session = create_session()
-    toast_record = ToastToUser(
-        chat_id=chat_id,
-        generated_toast=gen_toast,
-        toast_id=toast_id,
-        user_like=toast_id != None, # По умолчанию считаем, что пользователям сгенерированные тосты не нравятся
-    )
-    session.add(toast_record)
-    session.commit()
-    session.close()
+    with session_scope(session) as session:
+        # Текст сгенерированного тоста храним один раз, а юзеру записываем только его хэш
+        generated_id = None
+        if gen_toast:
+            generated_id = toast_hash(gen_toast)
+            session.execute(insert(GeneratedToast).prefix_with('OR IGNORE')
+                            .values(id=generated_id, toast_text=gen_toast))
+
+        toast_record = ToastToUser(
+            chat_id=chat_id,
+            generated_id=generated_id,
+            toast_id=toast_id,
+            user_like=toast_id != None, # По умолчанию считаем, что пользователям сгенерированные тосты не нравятся
+        )
+        session.add(toast_record)
 
+        # Отмечаем тост из базы в карте просмотренных
+        if toast_id:
+            session.flush()
+            seen_cache.add(session, chat_id, toast_id, toast_record.id)
 
-def get_all_generated(chat_id: int) -> Set[str]:
+
+def get_all_generated(chat_id: int, session: Any = None) -> Set[int]:
     """
-    Получение множества всех сгенерированных тостов, которые видел юзер (чтобы не повторяться)
+    Получение множества хэшей (toast_hash) всех сгенерированных тостов, которые видел юзер (чтобы не повторяться)
     """
-    session = create_session()
-    all_generated = session.query(ToastToUser.generated_toast).filter(
-        ToastToUser.chat_id == chat_id).all()
-    session.close()
-    return {gen_toast[0] for gen_toast in all_generated}
+    return generated_cache.get(chat_id, session)
@@ -0,0 +1,85 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from core import GENERATED_CACHE_SIZE
+from .database import SessionLocal
+from .models import ToastToUser
+from typing import Any, Set
+
+
+def toast_hash(toast_text: str) -> int:
+    """
+    64-битный хэш текста тоста (со знаком - чтобы помещался в INTEGER sqlite)
+    """
+    return int.from_bytes(hashlib.blake2b(toast_text.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+class GeneratedCache:
+    """
+    LRU-кэш хэшей сгенерированных тостов, которые видел пользователь, по chat_id
+
+    Для каждого чата помним, до какой записи toast_to_user множество актуально, и при обращении
+    дочитываем только новые записи. Так кэш не устаревает, даже если тосты юзеру записывает
+    другой процесс (генерация идет в отдельных процессах, а записывает тосты процесс бота)
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items: int = max_items
+        self.hashes: OrderedDict = OrderedDict()
+        self.total_items: int = 0
+        self.lock: threading.RLock = threading.RLock()
+
+    def get(self, chat_id: int, session: Any = None) -> Set[int]:
+        """
+        Хэши сгенерированных тостов, которые видел пользователь
+        """
+        with self.lock:
+            if chat_id in self.hashes:
+                self.hashes.move_to_end(chat_id)
+                hashes, last_record_id = self.hashes[chat_id][:2]
+            else:
+                hashes, last_record_id = set(), 0
+
+        own_session = session is None
+        if own_session:
+            session = SessionLocal()
+
+        # Дочитываем записи, появившиеся после прошлого обращения (множество одного чата меняет только поток этого чата)
+        records = session.query(ToastToUser.id, ToastToUser.generated_id) \
+            .filter(ToastToUser.chat_id == chat_id, ToastToUser.id > last_record_id) \
+            .order_by(ToastToUser.id)
+        for record_id, generated_id in records:
+            if generated_id is not None:
+                hashes.add(generated_id)
+            last_record_id = record_id
+
+        if own_session:
+            session.close()
+
+        self.put(chat_id, hashes, last_record_id)
+        return hashes
+
+    def put(self, chat_id: int, hashes: Set[int], last_record_id: int) -> None:
+        """
+        Добавление множества в кэш с вытеснением самых давних (вместе с множеством храним его учтенный размер)
+        """
+        with self.lock:
+            if chat_id in self.hashes:
+                self.total_items -= self.hashes.pop(chat_id)[2]
+            self.hashes[chat_id] = (hashes, last_record_id, len(hashes))
+            self.total_items += len(hashes)
+
+            while len(self.hashes) > 1 and self.total_items > self.max_items:
+                self.total_items -= self.hashes.popitem(last=False)[1][2]
+
+    def clear(self) -> None:
+        """
+        Очистка кэша
+        """
+        with self.lock:
+            self.hashes.clear()
+            self.total_items = 0
+
+
+# Экземпляр кэша на весь процесс
+generated_cache = GeneratedCache(GENERATED_CACHE_SIZE)
@@ -0,0 +1,111 @@
+import atexit
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from core import GENERATION_WORKERS, GENERATION_DEADLINE, TAG_BACKEND
+from .markov_services import generate_toast, preload_markov
+from .similarity_index import similarity_index
+from .tag_index import tag_index
+from typing import List, Optional, Tuple
+
+
+def init_worker() -> None:
+    """
+    Подготовка процесса-генератора: загружаем модель по всему корпусу и индекс для поиска по тегам
+    """
+    # Ошибка в initializer ломает весь пул, поэтому только логируем - модель и индекс соберутся при первом запросе
+    try:
+        preload_markov()
+        if TAG_BACKEND == 'similarity':
+            similarity_index.sync()
+        else:
+            tag_index.sync()
+    except Exception:
+        logging.exception("Can't prepare generation worker")
+
+
+class GenerationPool:
+    """
+    Пул процессов для генерации тостов (генерация - чистый CPU и держит GIL, так что потоки тут не помогают)
+
+    submit сразу возвращает future и срок (time.time()), к которому тост нужен, а get ждет результат только
+    до этого срока - сколько бы запрос ни простоял до вызова get. Задачу, срок которой прошел, пока она
+    стояла в очереди, процесс-генератор пропускает.
+    Каждый процесс - отдельный пул из одного процесса, и чат всегда генерирует в одном и том же
+    (chat_id % workers): запасные кандидаты и модели по тегам юзера лежат в памяти именно этого процесса.
+    У каждого процесса свой кэш моделей, модель по всему корпусу загружается при старте процесса
+    """
+
+    def __init__(self, workers: int, deadline: float):
+        self.workers: int = workers
+        self.deadline: float = deadline
+        self.pools: List[ProcessPoolExecutor] = []
+        self.lock: threading.Lock = threading.Lock()
+
+    def start(self) -> None:
+        """
+        Запуск процессов (если они еще не запущены)
+        """
+        with self.lock:
+            if self.workers and not self.pools:
+                # spawn, а не fork: бот уже многопоточный, и при fork процесс мог бы унаследовать чужие блокировки
+                self.pools = [ProcessPoolExecutor(max_workers=1, initializer=init_worker,
+                                                  mp_context=multiprocessing.get_context('spawn'))
+                              for _ in range(self.workers)]
+                # Процесс поднимается по первой задаче - даем каждому пустую, чтобы поднять все сразу
+                for pool in self.pools:
+                    pool.submit(int)
+
+    def submit(self, chat_id: int, tags: Optional[List[str]] = None) -> Tuple[Future, float]:
+        """
+        Запрос на генерацию тоста для юзера (tags - теги, если генерируем по тегам). Возвращает future и срок
+
+        Future вернет то же, что generate_toast. Если пул выключен, генерируем сразу в текущем потоке
+        """
+        deadline = time.time() + self.deadline
+        self.start()
+        pools = self.pools
+        future = Future()
+        if not pools:
+            future.set_result(generate_toast(chat_id, tags, deadline))
+            return future, deadline
+        try:
+            return pools[chat_id % len(pools)].submit(generate_toast, chat_id, tags, deadline), deadline
+        except BrokenProcessPool as error:
+            # Процесс упал, а пул еще не перезапущен - get разберется с этим как с упавшей задачей
+            future.set_exception(error)
+            return future, deadline
+
+    def get(self, future: Future, deadline: float) -> Tuple[bool, Optional[str]]:
+        """
+        Результат генерации. Если не успели к сроку или процесс упал - (True, None), то есть "тост не сгенерирован"
+        """
+        try:
+            return future.result(timeout=max(0.0, deadline - time.time()))
+        except TimeoutError:
+            future.cancel()
+            logging.warning(f"Generation missed the {self.deadline}s deadline")
+        except BrokenProcessPool:
+            logging.exception("Generation pool is broken, restarting it")
+            self.shutdown()
+        except Exception:
+            logging.exception("Generation failed")
+        return True, None
+
+    def shutdown(self) -> None:
+        """
+        Остановка процессов
+        """
+        with self.lock:
+            pools, self.pools = self.pools, []
+        for pool in pools:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Экземпляр пула на весь процесс
+generation_pool = GenerationPool(GENERATION_WORKERS, GENERATION_DEADLINE)
+
+atexit.register(generation_pool.shutdown)
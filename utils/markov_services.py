@@ -0,0 +1,264 @@
+import json
+import logging
+import markovify
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from core import (
+    MARKOV_CACHE_SIZE,
+    MARKOV_CACHE_CHARS,
+    MARKOV_BATCH_SIZE,
+    MARKOV_MAX_ATTEMPTS,
+    MARKOV_TIME_BUDGET,
+    MARKOV_POOL_SIZE,
+    MARKOV_POOL_CHATS
+)
+from .artifacts import artifact_path, write_artifact
+from .generated_cache import toast_hash
+from .database_services import (
+    get_all_generated,
+    get_corpus_version,
+    get_disliked,
+    select_all_toasts,
+    select_random_toasts,
+    select_tag_toasts
+)
+from typing import (
+    Any,
+    Callable,
+    Hashable,
+    List,
+    Optional,
+    Tuple
+)
+
+
+def get_markov(texts: List[str]) -> Any:
+    """
+    Метод получения модели Маркова (сразу компилируем ее - так генерация быстрее)
+    """
+    return markovify.Text(texts, state_size=3, retain_original=False).compile(inplace=True)
+
+
+class MarkovCache:
+    """
+    Общий для процесса LRU-кэш моделей Маркова
+
+    Ключ модели описывает ее входные данные (версия корпуса, дизлайки юзера, теги),
+    поэтому модель пересобирается, только если эти данные поменялись
+    """
+
+    def __init__(self, max_items: int, max_chars: int):
+        self.max_items: int = max_items
+        self.max_chars: int = max_chars
+        self.models: OrderedDict = OrderedDict()
+        self.total_chars: int = 0
+        self.lock: threading.RLock = threading.RLock()
+
+    def get(self, key: Hashable, get_texts: Callable[[], Optional[List[str]]]) -> Optional[Any]:
+        """
+        Модель по ключу: из кэша или собранная по текстам из get_texts
+
+        Возвращает None, если текстов для модели нет
+        """
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key][0]
+
+        # Собираем без блокировки, чтобы не держать остальные чаты (в худшем случае два потока соберут одну модель)
+        texts = get_texts()
+        if not texts:
+            return None
+
+        model = get_markov(texts)
+        self.put(key, model, sum(len(text) for text in texts))
+        return model
+
+    def put(self, key: Hashable, model: Any, size: int) -> None:
+        """
+        Добавление модели в кэш. size - размер корпуса модели в символах
+        """
+        with self.lock:
+            if key in self.models:
+                self.total_chars -= self.models.pop(key)[1]
+
+            self.models[key] = (model, size)
+            self.total_chars += size
+
+            # Выкидываем самые давние модели, пока не влезем в лимиты (последнюю оставляем всегда)
+            while len(self.models) > 1 and (len(self.models) > self.max_items or self.total_chars > self.max_chars):
+                self.total_chars -= self.models.popitem(last=False)[1][1]
+
+    def clear(self) -> None:
+        """
+        Очистка кэша
+        """
+        with self.lock:
+            self.models.clear()
+            self.total_chars = 0
+
+
+# Экземпляр кэша на весь процесс
+markov_cache = MarkovCache(MARKOV_CACHE_SIZE, MARKOV_CACHE_CHARS)
+
+
+def get_random_model(chat_id: int) -> Tuple[Hashable, Optional[Any]]:
+    """
+    Ключ и модель по всем тостам, которые юзер не дизлайкал
+    """
+    key = ('random', get_corpus_version(), frozenset(get_disliked(chat_id)))
+    return key, markov_cache.get(key, lambda: select_random_toasts(chat_id, True))
+
+
+def get_tag_model(chat_id: int, tags: List[str]) -> Tuple[Hashable, Optional[Any]]:
+    """
+    Ключ и модель по тостам с тегами юзера, которые он не дизлайкал
+    """
+    key = ('tags', get_corpus_version(), frozenset(
+        get_disliked(chat_id)), frozenset(tags))
+    return key, markov_cache.get(key, lambda: select_tag_toasts(
+        chat_id=chat_id, all_toasts=True, tags=tags))
+
+
+# Запасные сгенерированные тосты: chat_id -> (ключ модели, очередь кандидатов).
+# Очередь одного чата трогает только его поток, а сам словарь общий - меняем его под блокировкой.
+# В пуле процессов чат всегда генерирует в одном и том же процессе (см. GenerationPool), так что его очередь
+# не расходится с тем, что юзер уже видел
+candidate_pools: OrderedDict = OrderedDict()
+candidate_pools_lock = threading.Lock()
+
+
+def get_candidate_pool(chat_id: int, key: Hashable) -> deque:
+    """
+    Очередь запасных кандидатов юзера для модели с ключом key
+    """
+    with candidate_pools_lock:
+        if chat_id in candidate_pools and candidate_pools[chat_id][0] == key:
+            candidate_pools.move_to_end(chat_id)
+        else:
+            # Модель поменялась - старые кандидаты не подходят
+            candidate_pools.pop(chat_id, None)
+            candidate_pools[chat_id] = (key, deque(maxlen=MARKOV_POOL_SIZE))
+            if len(candidate_pools) > MARKOV_POOL_CHATS:
+                candidate_pools.popitem(last=False)
+        return candidate_pools[chat_id][1]
+
+
+def make_candidate(model: Any) -> Optional[str]:
+    """
+    Один сгенерированный тост (или None, если не получилось)
+    """
+    gen_toast = model.make_sentence()
+
+    # Если Марков вздумает писать стишки
+    return re.sub(r'\s(?=[A-ZА-Я])', '\n', gen_toast) if gen_toast else None
+
+
+def get_sentence_fit(model: Any, chat_id: int, key: Hashable, deadline: Optional[float] = None) -> Optional[str]:
+    """
+    Находим подходящий сгенерированный тост, который юзер еще не видел
+
+    Генерируем кандидатов пачками с ограничением на число попыток и время,
+    лишних кандидатов откладываем юзеру на потом. Если уложиться не удалось, возвращаем None
+
+    deadline - момент (time.time()), после которого генерировать уже бессмысленно
+    """
+    all_generated = get_all_generated(chat_id=chat_id)
+    pool = get_candidate_pool(chat_id, key)
+
+    # Сперва смотрим в отложенных кандидатах
+    while pool:
+        gen_toast = pool.popleft()
+        if toast_hash(gen_toast) not in all_generated:
+            return gen_toast
+
+    time_budget = MARKOV_TIME_BUDGET if deadline is None else min(MARKOV_TIME_BUDGET, deadline - time.time())
+    stop_time = time.monotonic() + time_budget
+    attempts = 0
+    found = None
+    while attempts < MARKOV_MAX_ATTEMPTS and time.monotonic() < stop_time:
+        for _ in range(min(MARKOV_BATCH_SIZE, MARKOV_MAX_ATTEMPTS - attempts)):
+            attempts += 1
+            gen_toast = make_candidate(model)
+            if not gen_toast or toast_hash(gen_toast) in all_generated or gen_toast == found or gen_toast in pool:
+                continue
+            if found is None:
+                found = gen_toast
+            elif len(pool) < MARKOV_POOL_SIZE:
+                pool.append(gen_toast)
+        if found is not None:
+            return found
+
+    logging.warning(f"No new toast for {chat_id} after {attempts} attempts")
+    return None
+
+
+def generate_toast(chat_id: int, tags: Optional[List[str]] = None,
+                   deadline: Optional[float] = None) -> Tuple[bool, Optional[str]]:
+    """
+    Генерация нового тоста для юзера: модель (по всем тостам или по тегам tags) + get_sentence_fit
+
+    Возвращает пару (нашлись ли тосты для модели, тост или None, если сгенерировать не вышло)
+    """
+    # Запрос долго ждал своей очереди - не тратим на него время
+    if deadline is not None and time.time() >= deadline:
+        return True, None
+
+    key, model = get_random_model(chat_id) if tags is None else get_tag_model(chat_id, tags)
+    if not model:
+        return False, None
+    return True, get_sentence_fit(model, chat_id, key, deadline)
+
+
+def build_markov_artifact(cache: bool = True) -> Optional[Any]:
+    """
+    Сборка скомпилированной модели по всему корпусу и сохранение ее рядом с БД
+    (вызывается при заполнении БД)
+
+    cache - оставить ли модель в кэше этого процесса
+    """
+    corpus_version = get_corpus_version()
+    texts = select_all_toasts()
+    if not texts:
+        return None
+
+    logging.info(f"Building Markov chain for corpus version {corpus_version}...")
+    model = get_markov(texts)
+    corpus_chars = sum(len(text) for text in texts)
+    write_artifact(artifact_path('markov', corpus_version, 'json'), lambda artifact_file: json.dump(
+        {'corpus_chars': corpus_chars, 'model': model.to_dict()}, artifact_file, ensure_ascii=False))
+
+    if cache:
+        markov_cache.put(('random', corpus_version, frozenset()), model, corpus_chars)
+    return model
+
+
+def ensure_markov_artifact() -> None:
+    """
+    Сборка артефакта модели по всему корпусу, если для текущей версии корпуса его нет
+    (для процессов-генераторов: сами они модель только загружают, а этот процесс ее в памяти не держит)
+    """
+    if not artifact_path('markov', get_corpus_version(), 'json').exists():
+        build_markov_artifact(cache=False)
+
+
+def preload_markov() -> Optional[Any]:
+    """
+    Загрузка модели по всему корпусу при старте бота: из артефакта,
+    а если его нет или он устарел - собираем и сохраняем заново
+    """
+    corpus_version = get_corpus_version()
+    path = artifact_path('markov', corpus_version, 'json')
+    if not path.exists():
+        return build_markov_artifact()
+
+    logging.info(f"Loading Markov chain from {path}")
+    with open(path, 'r', encoding='utf-8') as artifact_file:
+        artifact = json.load(artifact_file)
+    model = markovify.Text.from_dict(artifact['model'])
+
+    markov_cache.put(('random', corpus_version, frozenset()),
+                     model, artifact['corpus_chars'])
+    return model
@@ -0,0 +1,157 @@
+"""
+Версионные миграции схемы БД
+
+create_all создает только недостающие таблицы и не трогает существующие, поэтому все изменения
+уже созданных таблиц (индексы, ограничения, перенос данных) делаются здесь. Номер примененной миграции хранится
+в таблице schema_version, migrate() при старте применяет все, что новее.
+
+Проверка планов хот-запросов (ни один не должен читать таблицу целиком):
+
+    python -m utils.migrations
+"""
+import logging
+import re
+import sqlite3
+import sys
+from sqlalchemy import text
+from .database import engine
+from .generated_cache import toast_hash
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+
+def move_generated_texts(connection: Any) -> None:
+    """
+    Перенос текстов сгенерированных тостов из toast_to_user в generated_toasts (хэш считаем в питоне)
+    """
+    columns = {row[1] for row in connection.execute(text("PRAGMA table_info(toast_to_user)"))}
+    if 'generated_id' not in columns:
+        connection.execute(text("ALTER TABLE toast_to_user ADD COLUMN generated_id INTEGER"))
+    if 'generated_toast' not in columns:
+        return
+
+    rows = connection.execute(text("SELECT id, generated_toast FROM toast_to_user"
+                                   " WHERE generated_toast IS NOT NULL")).fetchall()
+    records = [{'id': record_id, 'generated_id': toast_hash(gen_toast), 'toast_text': gen_toast}
+               for record_id, gen_toast in rows]
+    if records:
+        connection.execute(text("INSERT OR IGNORE INTO generated_toasts (id, toast_text)"
+                                " VALUES (:generated_id, :toast_text)"), records)
+        connection.execute(text("UPDATE toast_to_user SET generated_id = :generated_id WHERE id = :id"), records)
+
+    # DROP COLUMN есть только в sqlite 3.35+, в старых просто оставляем колонку пустой
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        connection.execute(text("ALTER TABLE toast_to_user DROP COLUMN generated_toast"))
+    else:
+        connection.execute(text("UPDATE toast_to_user SET generated_toast = NULL"))
+
+
+# Миграции по порядку: (номер, описание, SQL-запросы или функции от соединения). Новые - только дописывать в конец.
+# Запросы пишем так, чтобы они ничего не ломали на свежей БД, где create_all уже создал все из models
+MIGRATIONS: List[Tuple[int, str, List[Union[str, Callable[[Any], None]]]]] = [
+    (1, 'per-user indexes', [
+        "CREATE INDEX IF NOT EXISTS ix_toast_to_user_chat_id_id ON toast_to_user (chat_id, id)",
+        "CREATE INDEX IF NOT EXISTS ix_toast_to_user_toast_id ON toast_to_user (toast_id)",
+        "CREATE INDEX IF NOT EXISTS ix_stage_to_user_chat_id_id ON stage_to_user (chat_id, id)",
+        "CREATE INDEX IF NOT EXISTS ix_user_tags_chat_id_id ON user_tags (chat_id, id)",
+    ]),
+    (2, 'unique tag names', [
+        # Дубли названий тегов сливаем в тег с наименьшим id: сначала перевешиваем связи с тостами
+        # (OR IGNORE - если тост уже связан с оставшимся тегом), потом удаляем лишнее
+        "UPDATE OR IGNORE toast_to_tag SET tag_id = ("
+        " SELECT min(kept.id) FROM tags AS kept JOIN tags AS dup ON dup.tag_name = kept.tag_name"
+        " WHERE dup.id = toast_to_tag.tag_id)"
+        " WHERE tag_id NOT IN (SELECT min(id) FROM tags GROUP BY tag_name)",
+        "DELETE FROM toast_to_tag WHERE tag_id NOT IN (SELECT min(id) FROM tags GROUP BY tag_name)",
+        "DELETE FROM tags WHERE id NOT IN (SELECT min(id) FROM tags GROUP BY tag_name)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_tags_tag_name ON tags (tag_name)",
+    ]),
+    (3, 'generated toasts stored once by hash', [move_generated_texts]),
+]
+
+# Запросы, которые бот делает на каждое сообщение (в том же виде, что в database_services и кэшах)
+HOT_QUERIES: Dict[str, str] = {
+    'last toast record': "SELECT max(id) FROM toast_to_user WHERE chat_id = 1 GROUP BY chat_id",
+    'disliked toasts': "SELECT toast_id FROM toast_to_user"
+                       " WHERE chat_id = 1 AND toast_id IS NOT NULL AND user_like = 0",
+    'seen since snapshot': "SELECT toast_id FROM toast_to_user"
+                           " WHERE chat_id = 1 AND toast_id IS NOT NULL AND id > 0",
+    'generated toasts': "SELECT id, generated_id FROM toast_to_user WHERE chat_id = 1 AND id > 0 ORDER BY id",
+    'generated text': "SELECT toast_text FROM generated_toasts WHERE id = 1",
+    'current stage': "SELECT stage_id FROM user_stage WHERE chat_id = 1",
+    'last stage': "SELECT stage_id FROM stage_to_user WHERE chat_id = 1 ORDER BY id DESC LIMIT 1",
+    'seen bitmap': "SELECT bitmap, last_record_id FROM seen_bitmaps WHERE chat_id = 1",
+    'last user tags': "SELECT user_tags FROM user_tags WHERE chat_id = 1 ORDER BY id DESC LIMIT 1",
+    'tag by name': "SELECT id FROM tags WHERE tag_name = 'тост'",
+    'toast by id': "SELECT toast_text FROM toasts WHERE id = 1",
+    'new toast tags': "SELECT toast_to_tag.toast_id, tags.tag_name FROM toast_to_tag"
+                      " JOIN tags ON tags.id = toast_to_tag.tag_id"
+                      " WHERE toast_to_tag.toast_id > 0 ORDER BY toast_to_tag.toast_id",
+}
+
+# Шаг плана, который читает таблицу (или индекс) целиком
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+
+
+def get_schema_version(connection: Any) -> int:
+    """
+    Номер последней примененной миграции (0, если миграций еще не было)
+    """
+    connection.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+    return connection.execute(text("SELECT max(version) FROM schema_version")).scalar() or 0
+
+
+def migrate(bind: Any = engine) -> int:
+    """
+    Применение всех миграций новее текущей версии схемы, каждой в своей транзакции. Возвращает версию схемы
+    """
+    with bind.begin() as connection:
+        version = get_schema_version(connection)
+
+    for number, description, statements in MIGRATIONS:
+        if number <= version:
+            continue
+        logging.info(f"Applying migration {number}: {description}")
+        with bind.begin() as connection:
+            for statement in statements:
+                if callable(statement):
+                    statement(connection)
+                else:
+                    connection.execute(text(statement))
+            connection.execute(text("INSERT INTO schema_version (version) VALUES (:version)"),
+                               {'version': number})
+        version = number
+
+    return version
+
+
+def full_scans(bind: Any = engine) -> Dict[str, List[str]]:
+    """
+    Хот-запросы, в плане которых (EXPLAIN QUERY PLAN) есть чтение таблицы целиком: название -> такие шаги плана
+    """
+    scans = {}
+    with bind.connect() as connection:
+        for name, query in HOT_QUERIES.items():
+            plan = [row[-1] for row in connection.execute(text(f"EXPLAIN QUERY PLAN {query}"))]
+            steps = [step for step in plan if FULL_SCAN.match(step)]
+            if steps:
+                scans[name] = steps
+    return scans
+
+
+def main() -> None:
+    from .database import Base
+    from . import models  # noqa: F401 - регистрирует таблицы в Base
+
+    Base.metadata.create_all(engine)
+    print(f"schema version {migrate()}")
+
+    scans = full_scans()
+    for name, steps in scans.items():
+        print(f"{name}: {'; '.join(steps)}")
+    if scans:
+        sys.exit(1)
+    print(f"{len(HOT_QUERIES)} hot queries, no full scans")
+
+
+if __name__ == '__main__':
+    main()
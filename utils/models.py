@@ -3,7 +3,9 @@ from sqlalchemy import (
     Integer,
     String,
     Boolean,
+    LargeBinary,
     ForeignKey,
+    Index,
     PrimaryKeyConstraint)
 from sqlalchemy.sql import expression
 from .database import Base
@@ -14,14 +16,40 @@ class ToastToUser(Base):
     Таблица с информацией о том, какой тост мы кому послали
     """
     __tablename__ = 'toast_to_user'
+    # Все запросы идут по chat_id с сортировкой или фильтром по id (sqlite читает индекс и в обратную сторону)
+    __table_args__ = (Index('ix_toast_to_user_chat_id_id', 'chat_id', 'id'),
+                      Index('ix_toast_to_user_toast_id', 'toast_id'))
+
     id = Column(Integer, primary_key=True)
     chat_id = Column(Integer)
-    generated_toast = Column(String(4000))
+    # Хэш сгенерированного тоста (id в generated_toasts)
+    generated_id = Column(Integer)
     toast_id = Column('toast_id', Integer, ForeignKey(
         "toasts.id", ondelete="cascade"))
     user_like = Column(Boolean, server_default=expression.true())
 
 
+class GeneratedToast(Base):
+    """
+    Таблица с текстами сгенерированных тостов, каждый текст хранится один раз
+    """
+    __tablename__ = 'generated_toasts'
+    # 64-битный хэш текста
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    toast_text = Column(String(4000))
+
+
+class SeenBitmap(Base):
+    """
+    Таблица со сжатыми битовыми картами тостов, которые видел пользователь
+    """
+    __tablename__ = 'seen_bitmaps'
+    chat_id = Column(Integer, primary_key=True)
+    bitmap = Column(LargeBinary)
+    # До какой записи toast_to_user карта актуальна
+    last_record_id = Column(Integer)
+
+
 class Stages(Base):
     """
     Таблица с названиями всех "стадий" бота
@@ -31,11 +59,23 @@ class Stages(Base):
     stage_name = Column(String(100))
 
 
+class UserStage(Base):
+    """
+    Таблица с текущей стадией каждого пользователя
+    """
+    __tablename__ = 'user_stage'
+    chat_id = Column(Integer, primary_key=True)
+    stage_id = Column('stage_id', Integer, ForeignKey(
+        "stages.id", ondelete="cascade"))
+
+
 class StageToUser(Base):
     """
-    Таблица с информацией о том, на какой стадии какой пользователь
+    Таблица с историей стадий пользователей (пишется, только если включен STAGE_HISTORY)
     """
     __tablename__ = 'stage_to_user'
+    __table_args__ = (Index('ix_stage_to_user_chat_id_id', 'chat_id', 'id'),)
+
     id = Column(Integer, primary_key=True)
     chat_id = Column(Integer)
     stage_id = Column('stage_id', Integer, ForeignKey(
@@ -47,6 +87,8 @@ class UserTags(Base):
     Таблица с информацией о том, какие теги какой пользователь вводил
     """
     __tablename__ = 'user_tags'
+    __table_args__ = (Index('ix_user_tags_chat_id_id', 'chat_id', 'id'),)
+
     id = Column(Integer, primary_key=True)
     chat_id = Column(Integer)
     user_tags = Column(String(4000))
@@ -66,6 +108,8 @@ class Tag(Base):
     Таблица с текстами тегов
     """
     __tablename__ = 'tags'
+    __table_args__ = (Index('ix_tags_tag_name', 'tag_name', unique=True),)
+
     id = Column(Integer, primary_key=True)
     tag_name = Column(String(100))
 
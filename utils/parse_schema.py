@@ -1,15 +1,14 @@
 from fake_useragent import UserAgent
-import requests
-from bs4 import BeautifulSoup
 import re
-from urllib.parse import urlparse, urlunparse
+from urllib.parse import urljoin, urlparse, urlunparse
 from tqdm import tqdm
 from .text_services import (
-    preprocess_text,
+    preprocess_many,
     create_tfidf,
-    get_top_tf_idf_words)
-from .database_services import add_toast
-from typing import List, Dict, Any
+    get_top_tf_idf_batch)
+from .bulk_writer import BulkWriter
+from .crawler import Crawler, Task
+from typing import List, Any, Optional, Tuple
 import logging
 
 
@@ -21,34 +20,28 @@ class PageParser:
     def __init__(self):
         self.url: str = ''
         self.site_name: str = ''
-        self.session: Any = requests.session()
         self.ua: Any = UserAgent(verify_ssl=False)
+        self.crawler: Any = None
         self.toasts: List[str] = None
         self.toasts_preprocessed: List[str] = []
         self.tags: List[str] = []
         self.tags_preprocessed: List[str] = []
-        self.all_tags: Dict[str, int] = {}
-
-    def get_soup(self, url: str) -> Any:
-        """
-        Получение "супа" сайта по url
-        """
-        try:
-            req = self.session.get(url, headers={'User-Agent': self.ua.random})
-        except Exception:
-            # Если зашли сюда, значиит, какие-то проблемы с выбранным браузером и нужно попробовать снова
-            return self.get_soup(url)
-        page = req.text
-        return BeautifulSoup(page, 'html.parser')
+        # Леммы тостов со всех сайтов - для tf-idf по всему корпусу, и id этих тостов в БД
+        self.corpus_preprocessed: List[str] = []
+        self.corpus_ids: List[int] = []
 
     def preprocess(self) -> None:
         """
         Обработка (токенизация + лемматизация) данных
         """
         logging.info(f"Preprocessing texts & tags for {self.site_name}...")
-        for (i, toast) in tqdm(enumerate(self.toasts)):
-            self.toasts_preprocessed.append(" ".join(preprocess_text(toast)))
-            self.tags_preprocessed.append(preprocess_text(self.tags[i]))
+        self.toasts_preprocessed = [" ".join(lemmas) for lemmas in preprocess_many(self.toasts)]
+        self.corpus_preprocessed.extend(self.toasts_preprocessed)
+
+        # Тегов-разделов немного, поэтому обрабатываем каждый один раз
+        unique_tags = list(set(self.tags))
+        tags_lemmas = dict(zip(unique_tags, preprocess_many(unique_tags)))
+        self.tags_preprocessed = [tags_lemmas[tag] for tag in self.tags]
 
     def write_to_db(self) -> None:
         """
@@ -57,26 +50,24 @@ class PageParser:
         logging.info(f"Building TfIdf for {self.site_name}...")
         toasts_tfidf, feature_names = create_tfidf(self.toasts_preprocessed)
 
-        logging.info(f"Writing data from {self.site_name} to database...")
-        for (i, text) in tqdm(enumerate(self.toasts)):
-            # Вектор tf-idf для тоста
-            toast_vector = toasts_tfidf[i, :]
-
-            # Получаем список тегов-популярных лемм
-            tags = get_top_tf_idf_words(toast_vector, feature_names, 10)
+        # Получаем списки тегов-популярных лемм сразу для всех тостов
+        toasts_top_words = get_top_tf_idf_batch(toasts_tfidf, feature_names, 10)
 
-            # Объединяем список тегов-популярных лемм и тегов-разделов сайта
-            tags = set(tags).union(set(self.tags_preprocessed[i]))
+        logging.info(f"Writing data from {self.site_name} to database...")
+        # Пишем все одной транзакцией, id тегов берутся из общего словаря тегов
+        with BulkWriter() as writer:
+            for (i, text) in tqdm(enumerate(self.toasts)):
+                # Объединяем список тегов-популярных лемм и тегов-разделов сайта
+                tags = set(toasts_top_words[i]).union(set(self.tags_preprocessed[i]))
 
-            # Добавляем тост и теги в БД, меняем словарь тегов
-            self.all_tags = add_toast(tags, text, self.all_tags)[1]
+                # Добавляем тост и теги
+                self.corpus_ids.append(writer.add(text, tags))
 
-    def parse_page_pozdravuha(self, url: str, header_tag: str) -> None:
+    def parse_page_pozdravuha(self, task: Task, page_soup: Any) -> Tuple[List[Tuple[str, str]], List[Task]]:
         """
-        Рекурсивный парсинг страниц раздела сайта pozdravuha.ru
+        Парсинг страницы раздела сайта pozdravuha.ru (task.meta - тег раздела)
         """
-        # Получаем "суп" страницы
-        page_soup = self.get_soup(url)
+        page_toasts = []
 
         # Находим все тосты на странице
         for toast in page_soup.find_all('p', {'class': 'item pozdravuha_ru_text'}):
@@ -89,140 +80,142 @@ class PageParser:
             toast = re.sub(r'\n+', '\n', re.sub(r'\r', '',
                            toast.get_text('\n').replace('\xa0', ' ')))
 
-            # Добавляем тост и тег раздела в соответствующие списки
+            # Добавляем тост и тег раздела
             if toast:
-                self.toasts.append(toast)
-                self.tags.append(header_tag)
+                page_toasts.append((toast, task.meta))
 
-        # Находим ссылку на следующую страницу
+        # Находим ссылку на следующую страницу и ставим ее в очередь
         next_page = page_soup.find('div', {'class': 'pages_next'})
-
         if next_page:
-            # Заменяем путь в ссылке на следующую страницу и парсим ее
-            next_page = urlunparse(urlparse(url)._replace(
+            # Заменяем путь в ссылке на следующую страницу
+            next_page = urlunparse(urlparse(task.url)._replace(
                 path=next_page.find('a')['href']))
-            self.parse_page_pozdravuha(next_page, header_tag)
+            return page_toasts, [Task((task.key[0], task.key[1] + 1), next_page, self.parse_page_pozdravuha, task.meta)]
+
+        return page_toasts, []
 
-    def parse_pozdravuha(self) -> None:
+    def parse_pozdravuha(self, task: Task, soup: Any) -> Tuple[List[Tuple[str, str]], List[Task]]:
         """
-        Парсинг сайта pozdravuha.ru
+        Парсинг главной страницы сайта pozdravuha.ru
         """
-        # "Суп" главной страницы
-        soup = self.get_soup(self.url)
+        # Находим ссылки на все разделы с тостами и ставим их в очередь
+        sections = []
+        for (i, link) in enumerate(soup.find('div', {'class': 'filters menu-block bg3 menu-left-subrazd'}).find_all('a')):
+            # Заменяем путь в ссылке на раздел
+            page_url = urlunparse(urlparse(self.url)._replace(path=link['href']))
+            sections.append(Task((i, 0), page_url, self.parse_page_pozdravuha, link.text))
+        return [], sections
 
-        # Находим ссылки на все разделы с тостами
-        for i in tqdm(soup.find('div', {'class': 'filters menu-block bg3 menu-left-subrazd'}).find_all('a')):
-            # Заменяем путь в ссылке на раздел и парсим ее
-            page_url = urlunparse(urlparse(self.url)._replace(path=i['href']))
-            self.parse_page_pozdravuha(page_url, i.text)
-
-    def parse_page_toast(self, url: str, header_tag: str) -> None:
+    def parse_page_toast(self, task: Task, soup: Any) -> Tuple[List[Tuple[str, str]], List[Task]]:
         """
-        Парсинг страницы сайта toast.ru
+        Парсинг страницы сайта toast.ru (task.meta - тег раздела)
         """
+        page_toasts = []
         curr_toast = ''
 
-        # "Суп" страницы
-        soup = self.get_soup(url)
-
         # Находим все текстовые блоки
         for toast in soup.find_all('p')[1:]:
 
             # Если выполнились условия, то мы на промежуточном блоке м-ду тостами. Записываем текущий тост в список
             if len(toast.attrs) != 0 and curr_toast:
-                # Убираем из тоста ненужные переносы и добавляем в списки тост и теги
-                self.toasts.append(
-                    re.sub(r'\n(?=[а-я])', r' ', curr_toast.strip()))
-                self.tags.append(header_tag)
+                # Убираем из тоста ненужные переносы и добавляем тост и тег
+                page_toasts.append(
+                    (re.sub(r'\n(?=[а-я])', r' ', curr_toast.strip()), task.meta))
                 curr_toast = ''
 
             # По этим параметрам отделяем тег с тостом от других тегов и добавляем его к текущему
             elif not toast.find('p') and not toast.find('font') and 'align' not in toast.attrs:
                 curr_toast += toast.text + '\n'
 
-        return soup
+        # Тут нет кнопки "следующая страница", поэтому на первой странице раздела находим ссылки на остальные
+        pages = []
+        t = soup.find('td', {'class': 'navlink'})
+        if task.key[1] == 0 and t and len(t) > 1:
+            for (j, link) in enumerate(t.find_all('a')[1:], start=1):
+                # Заменяем путь в ссылке на страницу раздела
+                new_url = urlunparse(urlparse(self.url)._replace(path=link['href']))
+                pages.append(Task((task.key[0], j), new_url, self.parse_page_toast, task.meta))
 
-    def parse_toast(self) -> None:
+        return page_toasts, pages
+
+    def parse_toast(self, task: Task, soup: Any) -> Tuple[List[Tuple[str, str]], List[Task]]:
         """
-        Парсинг сайта toast.ru
+        Парсинг главной страницы сайта toast.ru
         """
+        # Находим ссылки на все разделы с тостами и ставим их в очередь
+        sections = []
+        for (i, link) in enumerate(soup.find_all('a', {'class': 'menutoast'})):
+            # Заменяем путь в ссылке на раздел
+            page_url = urlunparse(urlparse(self.url)._replace(path=link['href']))
+            sections.append(Task((i, 0), page_url, self.parse_page_toast, link.text))
+        return [], sections
 
-        # "Суп" главной страницы
-        soup = self.get_soup(self.url)
-
-        # Находим ссылки на все разделы с тостами
-        for i in tqdm(soup.find_all('a', {'class': 'menutoast'})):
-            # Заменяем путь в ссылке на раздел и парсим его
-            page_url = urlunparse(urlparse(self.url)._replace(path=i['href']))
-
-            # Тут нет кнопки "следующая страница", поэтому сперва парсим первую в разделе и находим ссылки на остальные страницы
-            page_soup = self.parse_page_toast(page_url, i.text)
-            t = page_soup.find('td', {'class': 'navlink'})
-
-            # Если у нас больше одной страницы, то парсим остальные
-            if t and len(t) > 1:
-                for j in t.find_all('a')[1:]:
-                    # Заменяем путь в ссылке на страницу раздела и парсим ее
-                    new_url = urlunparse(
-                        urlparse(self.url)._replace(path=j['href']))
-                    self.parse_page_toast(new_url, i.text)
-
-    def parse_alcofan(self) -> None:
+    def parse_page_alcofan(self, task: Task, page_soup: Any) -> Tuple[List[Tuple[str, str]], List[Task]]:
         """
-        Парсинг сайта alcofan.com
+        Парсинг раздела сайта alcofan.com (тут в разделах везде по 1 странице, task.meta - тег раздела)
         """
+        # Находим все тосты
+        page_info = page_soup.find('article').find_all('p')
 
-        # "Суп" главной страницы
-        soup = self.get_soup(self.url)
-
-        # Находим ссылки на все разделы с тостами
-        for i in tqdm(soup.find_all('a', {'rel': 'noopener'})):
-            # Полная ссылка на раздел и тег раздела
-            page_url = 'https:' + i['href']
-            header_tag = i.text.strip()
-
-            # "Суп" страницы раздела
-            page_soup = self.get_soup(page_url)
+        # Временный список (нужен, тк в каждом разделе первый тег - описание раздела)
+        page_toasts = []
 
-            # Назодим все тосты (тут в разделах везде по 1 странице)
-            page_info = page_soup.find('article').find_all('p')
+        for toast in page_info:
+            # Отделяем от других тегов
+            if toast.text not in ['', '*****'] and not toast.find('strong') and not toast.text.startswith('Тосты на'):
+                # Убираем ненужные символы из текста тоста и добавляем его и тег раздела
+                page_toasts.append((toast.get_text(
+                    '\n').replace('\xa0', ' ').lstrip(' *'), task.meta))
 
-            # Временные списки (нужны, тк в каждом разделе первый тег - описание раздела)
-            page_toasts, page_tags = [], []
+        return page_toasts[1:], []
 
-            for toast in page_info:
-                # Отделяем от дрцгих тегов
-                if toast.text not in ['', '*****'] and not toast.find('strong') and not toast.text.startswith('Тосты на'):
-                    # Убираем ненужные символы из текста тоста и добавляем его и тег раздела в списки
-                    page_toasts.append(toast.get_text(
-                        '\n').replace('\xa0', ' ').lstrip(' *'))
-                    page_tags.append(header_tag)
-
-            # Теперь добавляем в общие списки
-            self.toasts.extend(page_toasts[1:])
-            self.tags.extend(page_tags[1:])
+    def parse_alcofan(self, task: Task, soup: Any) -> Tuple[List[Tuple[str, str]], List[Task]]:
+        """
+        Парсинг главной страницы сайта alcofan.com
+        """
+        # Находим ссылки на все разделы с тостами и ставим их в очередь
+        sections = []
+        for (i, link) in enumerate(soup.find_all('a', {'rel': 'noopener'})):
+            # Полная ссылка на раздел (ссылки без протокола) и тег раздела
+            page_url = urljoin(self.url, link['href'])
+            sections.append(Task((i,), page_url, self.parse_page_alcofan, link.text.strip()))
+        return [], sections
 
-    def parse_site(self, url: str) -> None:
+    def crawl_site(self, url: str, site_name: Optional[str] = None) -> None:
         """
-        Объединяющая функция, в которую передается url
+        Обход сайта и сбор тостов с тегами разделов
+
+        site_name - название сайта, если его нельзя понять по url (например, для локальной копии сайта)
         """
         # Инициализиируем экземпляры всего, что только можно
-        self.session = requests.session()
         self.ua = UserAgent(verify_ssl=False)
+        self.crawler = Crawler(user_agent=lambda: self.ua.random)
         self.url = url
         self.toasts, self.toasts_preprocessed, self.tags, self.tags_preprocessed = [], [], [], []
 
         # Это просто 1 слово - название сайта, чтобы не корячиться с длинными ссылками
-        self.site_name = urlparse(url).netloc.split('.')[-2]
+        self.site_name = site_name or urlparse(url).netloc.split('.')[-2]
 
-        # По этому слову определяем, какая ф-я нужна для парсинга
+        # По этому слову определяем, какая ф-я нужна для парсинга главной страницы
         logging.info(f"Parsing {self.site_name}...")
         if self.site_name == 'alcofan':
-            self.parse_alcofan()
+            handler = self.parse_alcofan
         elif self.site_name == 'toast':
-            self.parse_toast()
+            handler = self.parse_toast
         else:
-            self.parse_pozdravuha()
+            handler = self.parse_pozdravuha
+
+        # Обходим все страницы сайта и собираем тосты и теги разделов
+        for toast, tag in self.crawler.crawl([Task((), url, handler)]):
+            self.toasts.append(toast)
+            self.tags.append(tag)
+
+    def parse_site(self, url: str, site_name: Optional[str] = None) -> None:
+        """
+        Объединяющая функция, в которую передается url
+        """
+        # Собираем тосты
+        self.crawl_site(url, site_name)
 
         # Препроцессинг
         self.preprocess()
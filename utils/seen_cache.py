@@ -0,0 +1,181 @@
+import threading
+import zlib
+import numpy as np
+from collections import OrderedDict
+from sqlalchemy import and_, event
+from core import SEEN_CACHE_BYTES, SEEN_SNAPSHOT_EVERY
+from .database import SessionLocal
+from .models import (
+    SeenBitmap,
+    ToastToUser
+)
+from typing import Any, Dict, Optional
+
+
+class SeenSet:
+    """
+    Битовая карта id тостов, которые видел пользователь (бит i - тост с id i)
+    """
+
+    def __init__(self, data: bytes = b''):
+        self.bits: bytearray = bytearray(data)
+        # Сколько просмотров добавлено после последнего записанного снимка
+        self.unsaved: int = 0
+
+    def add(self, toast_id: int) -> None:
+        """
+        Отметка тоста как просмотренного
+        """
+        byte = toast_id >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte - len(self.bits) + 1))
+        self.bits[byte] |= 1 << (toast_id & 7)
+
+    def __contains__(self, toast_id: int) -> bool:
+        """
+        Видел ли пользователь тост
+        """
+        byte = toast_id >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] >> (toast_id & 7) & 1)
+
+    def unseen(self, max_id: int) -> Any:
+        """
+        Массив id от 1 до max_id, которых нет в карте
+        """
+        seen = np.unpackbits(np.frombuffer(self.bits, dtype=np.uint8), bitorder='little')[:max_id + 1]
+        unseen = np.ones(max_id + 1, dtype=bool)
+        unseen[0] = False
+        unseen[:len(seen)] &= seen == 0
+        return np.flatnonzero(unseen)
+
+    def compress(self) -> bytes:
+        """
+        Сжатая карта для записи в БД
+        """
+        return zlib.compress(bytes(self.bits))
+
+    @classmethod
+    def decompress(cls, data: Optional[bytes]) -> 'SeenSet':
+        """
+        Карта из сжатых данных из БД
+        """
+        return cls(zlib.decompress(data) if data else b'')
+
+
+class SeenCache:
+    """
+    LRU-кэш просмотренных тостов по chat_id
+
+    Карта загружается при первом обращении (снимок из seen_bitmaps + записи toast_to_user после него).
+    Новый просмотр - это бит в памяти и запись toast_to_user, а снимок карты пишется в БД только раз
+    в snapshot_every просмотров. Сам кэш общий для потоков бота, а карту одного чата меняет только поток
+    этого чата. Просмотры из еще не закоммиченной транзакции видны только в своей сессии
+    и попадают в карту после коммита
+    """
+
+    def __init__(self, max_bytes: int, snapshot_every: int):
+        self.max_bytes: int = max_bytes
+        self.snapshot_every: int = snapshot_every
+        self.seen_sets: OrderedDict = OrderedDict()
+        self.total_bytes: int = 0
+        self.lock: threading.RLock = threading.RLock()
+
+    def get(self, chat_id: int, session: Any = None) -> SeenSet:
+        """
+        Просмотренные тосты пользователя
+        """
+        # Если в еще не закоммиченной транзакции session были просмотры, отдаем копию карты вместе с ними
+        pending = session.info.get('seen_toasts', {}).get(chat_id) if session is not None else None
+        if pending:
+            seen = SeenSet(self.get(chat_id).bits)
+            for toast_id in pending['toast_ids']:
+                seen.add(toast_id)
+            return seen
+
+        with self.lock:
+            if chat_id in self.seen_sets:
+                self.seen_sets.move_to_end(chat_id)
+                return self.seen_sets[chat_id]
+
+        own_session = session is None
+        if own_session:
+            session = SessionLocal()
+
+        snapshot = session.get(SeenBitmap, chat_id)
+        seen = SeenSet.decompress(snapshot.bitmap if snapshot else None)
+
+        # Дочитываем то, что появилось после снимка
+        records = session.query(ToastToUser.toast_id) \
+            .filter(and_(ToastToUser.chat_id == chat_id, ToastToUser.toast_id != None,
+                         ToastToUser.id > (snapshot.last_record_id if snapshot else 0)))
+        for toast_id in records:
+            seen.add(toast_id[0])
+            seen.unsaved += 1
+
+        if own_session:
+            session.close()
+
+        self.put(chat_id, seen)
+        return seen
+
+    def put(self, chat_id: int, seen: SeenSet) -> None:
+        """
+        Добавление карты в кэш с вытеснением самых давних
+        """
+        with self.lock:
+            if chat_id in self.seen_sets:
+                self.total_bytes -= len(self.seen_sets.pop(chat_id).bits)
+            self.seen_sets[chat_id] = seen
+            self.total_bytes += len(seen.bits)
+
+            while len(self.seen_sets) > 1 and self.total_bytes > self.max_bytes:
+                self.total_bytes -= len(self.seen_sets.popitem(last=False)[1].bits)
+
+    def add(self, session: Any, chat_id: int, toast_id: int, record_id: int) -> None:
+        """
+        Отметка тоста как просмотренного в рамках сессии session (сама запись toast_to_user - на вызывающем)
+
+        record_id - id записи toast_to_user с этим тостом
+        """
+        # В карту просмотр попадет только после коммита: если апдейт откатится, в памяти должна остаться
+        # карта, как в БД. Саму карту читаем своей сессией, чтобы в кэш не попали незакоммиченные записи
+        seen_toasts = session.info.setdefault('seen_toasts', {})
+        if chat_id not in seen_toasts:
+            seen_toasts[chat_id] = {'toast_ids': [], 'saved': False}
+            event.listen(session, 'after_commit', lambda _: self.apply(chat_id, seen_toasts.pop(chat_id)), once=True)
+        pending = seen_toasts[chat_id]
+        pending['toast_ids'].append(toast_id)
+
+        seen = self.get(chat_id)
+        if seen.unsaved + len(pending['toast_ids']) >= self.snapshot_every:
+            snapshot = SeenSet(seen.bits)
+            for pending_id in pending['toast_ids']:
+                snapshot.add(pending_id)
+            session.merge(SeenBitmap(chat_id=chat_id, bitmap=snapshot.compress(), last_record_id=record_id))
+            pending['saved'] = True
+
+    def apply(self, chat_id: int, pending: Dict[str, Any]) -> None:
+        """
+        Перенос закоммиченных просмотров в карту из кэша (если ее вытеснили, она загрузится из БД)
+        """
+        with self.lock:
+            seen = self.seen_sets.get(chat_id)
+            if seen is None:
+                return
+            size = len(seen.bits)
+            for toast_id in pending['toast_ids']:
+                seen.add(toast_id)
+            seen.unsaved = 0 if pending['saved'] else seen.unsaved + len(pending['toast_ids'])
+            self.total_bytes += len(seen.bits) - size
+
+    def clear(self) -> None:
+        """
+        Очистка кэша
+        """
+        with self.lock:
+            self.seen_sets.clear()
+            self.total_bytes = 0
+
+
+# Экземпляр кэша на весь процесс
+seen_cache = SeenCache(SEEN_CACHE_BYTES, SEEN_SNAPSHOT_EVERY)
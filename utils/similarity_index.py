@@ -0,0 +1,144 @@
+import logging
+import threading
+import numpy as np
+from core import SIMILARITY_SAVE_ROWS
+from .artifacts import artifact_path, artifact_version, find_artifact, write_artifact
+from .database import SessionLocal
+from .models import Toast
+from .text_services import preprocess_many
+from .tfidf_model import tfidf_model
+from typing import Any, List
+
+
+class SimilarityIndex:
+    """
+    Матрица tf-idf всего корпуса в памяти (строки нормированы по L2): поиск тостов
+    по косинусной близости к запросу одним умножением разреженной матрицы на вектор
+
+    Матрица хранится артефактом рядом с БД, новые тосты дочитываются из БД и векторизуются при поиске.
+    Индекс общий для потоков бота: дочитывание идет под блокировкой, а поиск работает со снимком матрицы
+    """
+
+    def __init__(self):
+        self.matrix: Any = None
+        self.toast_ids: Any = np.zeros(0, dtype=np.int64)
+        # Максимальный id тоста, загруженный в матрицу
+        self.synced_id: int = 0
+        # Сколько строк дописано в матрицу после загрузки или сохранения артефакта
+        self.unsaved: int = 0
+        self.lock: threading.RLock = threading.RLock()
+
+    def load(self) -> None:
+        """
+        Загрузка матрицы из артефакта (если он собран для текущей модели tf-idf)
+        """
+        tfidf_model.ensure()
+        self.clear()
+
+        path = find_artifact('similarity', 'npz')
+        if path is None:
+            return
+        from scipy.sparse import csr_matrix
+        with np.load(path) as artifact:
+            if int(artifact['tfidf_version']) != tfidf_model.version:
+                return
+            self.matrix = csr_matrix((artifact['data'], artifact['indices'], artifact['indptr']),
+                                        shape=tuple(artifact['shape']))
+            self.toast_ids = artifact['toast_ids']
+        self.synced_id = artifact_version(path)
+        logging.info(f"Loaded similarity matrix from {path}")
+
+    def save(self) -> None:
+        """
+        Сохранение матрицы артефактом
+        """
+        write_artifact(artifact_path('similarity', self.synced_id, 'npz'), lambda artifact_file: np.savez(
+            artifact_file, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+            shape=np.array(self.matrix.shape), toast_ids=self.toast_ids,
+            tfidf_version=np.array(tfidf_model.version)), binary=True)
+        self.unsaved = 0
+
+    def sync(self) -> None:
+        """
+        Векторизация тостов, которых еще нет в матрице (при первом вызове - загрузка артефакта)
+
+        Тосты читаем своей короткой сессией и векторизуем без блокировки индекса, под блокировкой только
+        дописываем матрицу: сессия апдейта может держать блокировку записи sqlite, и ждать ее под блокировкой
+        индекса - значит ждать друг друга с потоком, которому нужен индекс
+        """
+        with self.lock:
+            if self.matrix is None:
+                self.load()
+            synced_id, empty = self.synced_id, self.matrix is None
+
+        session = SessionLocal()
+        rows = session.query(Toast.id, Toast.toast_text) \
+            .filter(Toast.id > synced_id) \
+            .order_by(Toast.id).all()
+        session.close()
+
+        if not rows and not empty:
+            return
+
+        if rows:
+            logging.info(f"Vectorizing {len(rows)} new toasts for similarity search...")
+        new_matrix = tfidf_model.transform([" ".join(lemmas) for lemmas in preprocess_many([row[1] for row in rows])])
+        self.add([row[0] for row in rows], new_matrix)
+
+    def add(self, toast_ids: List[int], new_matrix: Any) -> None:
+        """
+        Дописывание уже векторизованных тостов: строки new_matrix - тосты toast_ids по возрастанию id
+        (например, матрица, которую tf-idf получил при обучении на корпусе заливки)
+        """
+        new_ids = np.array(toast_ids, dtype=np.int64)
+
+        from scipy.sparse import vstack
+        with self.lock:
+            if self.matrix is None:
+                self.load()
+            # Пока мы векторизовали, часть тостов (или все) мог дописать другой поток
+            if self.matrix is not None and (not len(new_ids) or new_ids[-1] <= self.synced_id):
+                return
+            fresh = new_ids > self.synced_id
+            if not fresh.all():
+                new_matrix, new_ids = new_matrix[np.flatnonzero(fresh)], new_ids[fresh]
+
+            new_matrix = new_matrix.tocsr()
+            self.matrix = new_matrix if self.matrix is None else vstack((self.matrix, new_matrix), format='csr')
+            self.toast_ids = np.concatenate((self.toast_ids, new_ids))
+            self.synced_id = int(self.toast_ids[-1]) if len(self.toast_ids) else 0
+            self.unsaved += len(new_ids)
+
+            # Набралось достаточно новых строк (например, первая сборка или много мелких дочитываний) -
+            # сохраняем, чтобы при следующем старте не векторизовать их заново
+            if self.unsaved >= SIMILARITY_SAVE_ROWS:
+                self.save()
+
+    def search(self, tags: List[str]) -> List[int]:
+        """
+        id тостов, похожих на запрос, по убыванию косинусной близости (тосты без общих слов не попадают)
+        """
+        with self.lock:
+            matrix, toast_ids = self.matrix, self.toast_ids
+        if matrix is None or not tags:
+            return []
+
+        # Строки матрицы и вектор запроса уже нормированы, так что скалярное произведение - это косинус
+        query = tfidf_model.transform([" ".join(tags)])
+        scores = (matrix @ query.T).toarray().ravel()
+        found = np.flatnonzero(scores > 0)
+        return toast_ids[found[np.argsort(-scores[found], kind='stable')]].tolist()
+
+    def clear(self) -> None:
+        """
+        Очистка индекса
+        """
+        with self.lock:
+            self.matrix = None
+            self.toast_ids = np.zeros(0, dtype=np.int64)
+            self.synced_id = 0
+            self.unsaved = 0
+
+
+# Экземпляр индекса на весь процесс
+similarity_index = SimilarityIndex()
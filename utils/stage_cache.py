@@ -0,0 +1,164 @@
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from sqlalchemy import event, insert
+from core import STAGE_CACHE_SIZE, STAGE_HISTORY, STAGE_HISTORY_BATCH
+from .database import SessionLocal
+from .models import (
+    Stages,
+    StageToUser,
+    UserStage
+)
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class StageCache:
+    """
+    Текущие стадии пользователей: таблица user_stage + кэш в памяти со сквозной записью
+
+    Названия стадий загружаются из БД один раз, история стадий (если включена)
+    копится в памяти и пишется в stage_to_user пачками. Кэш общий для всех потоков бота.
+    Новая стадия попадает в кэш только после коммита, а до него видна только в своей сессии
+    """
+
+    def __init__(self, max_items: int, history: bool, history_batch: int):
+        self.max_items: int = max_items
+        self.history: bool = history
+        self.history_batch: int = history_batch
+        self.stage_ids: Dict[str, int] = {}
+        self.stage_names: Dict[int, str] = {}
+        self.current: OrderedDict = OrderedDict()
+        self.pending: List[Tuple[int, int]] = []
+        self.lock: threading.RLock = threading.RLock()
+
+    def load(self, session: Any = None) -> None:
+        """
+        Загрузка названий всех стадий
+        """
+        own_session = session is None
+        if own_session:
+            session = SessionLocal()
+        stages = session.query(Stages.id, Stages.stage_name).all()
+        if own_session:
+            session.close()
+
+        # Подменяем словари целиком, чтобы другие потоки не увидели их недостроенными
+        self.stage_ids = {stage_name: stage_id for stage_id, stage_name in stages}
+        self.stage_names = {stage_id: stage_name for stage_id, stage_name in stages}
+
+    def stage_id(self, stage: str) -> int:
+        """
+        id стадии по названию
+        """
+        if stage not in self.stage_ids:
+            self.load()
+        return self.stage_ids[stage]
+
+    def stage_name(self, stage_id: int) -> str:
+        """
+        Название стадии по id
+        """
+        if stage_id not in self.stage_names:
+            self.load()
+        return self.stage_names[stage_id]
+
+    def remember(self, chat_id: int, stage_id: int) -> None:
+        """
+        Запоминаем стадию юзера в памяти
+        """
+        with self.lock:
+            self.current[chat_id] = stage_id
+            self.current.move_to_end(chat_id)
+            if len(self.current) > self.max_items:
+                self.current.popitem(last=False)
+
+    def get(self, chat_id: int, session: Any = None) -> Optional[int]:
+        """
+        id текущей стадии юзера (None, если юзер у нас впервые)
+        """
+        # Стадия, записанная в еще не закоммиченной транзакции session
+        if session is not None and chat_id in session.info.get('stages', {}):
+            return session.info['stages'][chat_id][-1]
+
+        with self.lock:
+            if chat_id in self.current:
+                self.current.move_to_end(chat_id)
+                return self.current[chat_id]
+
+        own_session = session is None
+        if own_session:
+            session = SessionLocal()
+
+        stage_id = session.query(UserStage.stage_id).filter(UserStage.chat_id == chat_id).scalar()
+
+        # Юзеры, которые были у нас до появления user_stage: берем стадию из истории
+        if stage_id is None:
+            stage_id = session.query(StageToUser.stage_id) \
+                .filter(StageToUser.chat_id == chat_id) \
+                .order_by(StageToUser.id.desc()) \
+                .limit(1).scalar()
+
+        if own_session:
+            session.close()
+
+        if stage_id is not None:
+            self.remember(chat_id, stage_id)
+        return stage_id
+
+    def set(self, session: Any, chat_id: int, stage_id: int) -> None:
+        """
+        Запись новой стадии юзера в рамках сессии session
+        """
+        session.merge(UserStage(chat_id=chat_id, stage_id=stage_id))
+
+        # В кэш и в историю - только после коммита: если апдейт откатится, в памяти должна остаться
+        # стадия из БД, а в истории не должно быть стадий, которых не было
+        stages = session.info.setdefault('stages', {})
+        if chat_id not in stages:
+            stages[chat_id] = []
+            event.listen(session, 'after_commit', lambda _: self.committed(chat_id, stages.pop(chat_id)), once=True)
+        stages[chat_id].append(stage_id)
+
+    def committed(self, chat_id: int, stage_ids: List[int]) -> None:
+        """
+        Стадии юзера из закоммиченной транзакции: последняя - в кэш, все - в историю
+        """
+        self.remember(chat_id, stage_ids[-1])
+
+        if self.history:
+            with self.lock:
+                self.pending.extend((chat_id, stage_id) for stage_id in stage_ids)
+                full = len(self.pending) >= self.history_batch
+            if full:
+                self.flush()
+
+    def flush(self) -> None:
+        """
+        Запись накопленной истории стадий своей сессией (в чужой транзакции история пропала бы при ее откате)
+        """
+        with self.lock:
+            if not self.pending:
+                return
+            rows, self.pending = self.pending, []
+
+        session = SessionLocal()
+        try:
+            session.execute(insert(StageToUser), [{'chat_id': chat_id, 'stage_id': stage_id}
+                                                  for chat_id, stage_id in rows])
+            session.commit()
+        except Exception:
+            # Не теряем историю: вернем строки в очередь, запишутся со следующей пачкой
+            session.rollback()
+            with self.lock:
+                self.pending = rows + self.pending
+            logging.exception("Can't write stage history")
+        finally:
+            session.close()
+
+
+# Экземпляр кэша на весь процесс
+stage_cache = StageCache(STAGE_CACHE_SIZE, STAGE_HISTORY, STAGE_HISTORY_BATCH)
+
+# Не теряем историю при остановке бота
+atexit.register(stage_cache.flush)
@@ -0,0 +1,132 @@
+import threading
+import numpy as np
+from array import array
+from bisect import insort
+from sqlalchemy.sql import func
+from .database import SessionLocal
+from .models import (
+    Toast,
+    Tag,
+    ToastToTag
+)
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Set
+)
+
+
+class TagIndex:
+    """
+    Инвертированный индекс тегов в памяти: название тега -> отсортированный массив id тостов
+
+    Строится из toast_to_tag при старте, пополняется из add_toast,
+    а тосты, добавленные другими процессами, подтягивает при поиске.
+    Индекс общий для потоков бота, все операции с ним идут под блокировкой
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, array] = {}
+        # Максимальный id тоста, загруженный из БД
+        self.synced_id: int = 0
+        # Тосты, добавленные в этом процессе после последней загрузки из БД
+        self.added: Set[int] = set()
+        self.lock: threading.RLock = threading.RLock()
+
+    def add(self, toast_id: int, tags: Iterable[str]) -> None:
+        """
+        Добавление тоста с тегами в индекс
+        """
+        with self.lock:
+            if toast_id <= self.synced_id or toast_id in self.added:
+                return
+            self.added.add(toast_id)
+
+            for tag in set(tags):
+                posting = self.postings.setdefault(tag, array('i'))
+                # id новых тостов растут, поэтому почти всегда просто дописываем в конец
+                if not posting or posting[-1] < toast_id:
+                    posting.append(toast_id)
+                else:
+                    insort(posting, toast_id)
+
+    def sync(self) -> None:
+        """
+        Загрузка из БД связей тост-тег, которых еще нет в индексе
+
+        Читаем своей короткой сессией и без блокировки индекса, а под блокировку берем только слияние:
+        сессия апдейта может держать блокировку записи sqlite, и ждать ее под блокировкой индекса -
+        значит ждать друг друга с потоком, которому нужен индекс
+        """
+        synced_id = self.synced_id
+        session = SessionLocal()
+        try:
+            max_id = session.query(func.max(Toast.id)).scalar() or 0
+            if max_id <= synced_id:
+                return
+            rows = session.query(ToastToTag.toast_id, Tag.tag_name) \
+                .join(Tag, Tag.id == ToastToTag.tag_id) \
+                .filter(ToastToTag.toast_id > synced_id, ToastToTag.toast_id <= max_id) \
+                .order_by(ToastToTag.toast_id) \
+                .yield_per(10000)
+
+            new_postings: Dict[str, List[int]] = {}
+            for toast_id, tag_name in rows:
+                toast_ids = new_postings.setdefault(tag_name, [])
+                # Пропускаем дубли названий тегов
+                if not toast_ids or toast_ids[-1] != toast_id:
+                    toast_ids.append(toast_id)
+        finally:
+            session.close()
+
+        with self.lock:
+            # Пока мы читали, индекс мог дочитать другой поток
+            if max_id <= self.synced_id:
+                return
+
+            for tag_name, toast_ids in new_postings.items():
+                # Пропускаем уже загруженные и уже добавленные в этом процессе тосты
+                toast_ids = [toast_id for toast_id in toast_ids
+                             if toast_id > self.synced_id and toast_id not in self.added]
+                if not toast_ids:
+                    continue
+                posting = self.postings.setdefault(tag_name, array('i'))
+                # Если в этом процессе уже добавлены тосты новее, сливаем с сортировкой
+                if posting and posting[-1] > toast_ids[0]:
+                    toast_ids = sorted(set(posting).union(toast_ids))
+                    del posting[:]
+                posting.extend(toast_ids)
+
+            self.synced_id = max_id
+            self.added = {toast_id for toast_id in self.added if toast_id > max_id}
+
+    def search(self, tags: Iterable[str]) -> List[int]:
+        """
+        id тостов, у которых есть хоть один из тегов, по убыванию числа совпавших тегов
+        """
+        # Копируем списки под блокировкой: пока на массив есть view numpy, дописать в него нельзя
+        with self.lock:
+            postings = [np.frombuffer(self.postings[tag], dtype=np.int32)
+                        for tag in set(tags) if tag in self.postings]
+            found = np.concatenate(postings) if postings else None
+            del postings
+        if found is None:
+            return []
+
+        toast_ids, counts = np.unique(found, return_counts=True)
+        # Сортируем по убыванию совпадений, при равенстве - по возрастанию id
+        return toast_ids[np.lexsort((toast_ids, -counts))].tolist()
+
+    def clear(self) -> None:
+        """
+        Очистка индекса
+        """
+        with self.lock:
+            self.postings.clear()
+            self.synced_id = 0
+            self.added.clear()
+
+
+# Экземпляр индекса на весь процесс
+tag_index = TagIndex()
@@ -0,0 +1,82 @@
+import threading
+from sqlalchemy import event, insert, select
+from .database import SessionLocal
+from .models import Tag
+from typing import Any, Dict, Iterable, Optional
+
+
+class TagVocabulary:
+    """
+    Словарь всех тегов в памяти: название тега -> id, общий для всего процесса
+
+    Загружается из БД один раз. Новые теги пишутся в БД через INSERT OR IGNORE (названия тегов уникальны),
+    так что одновременное добавление одного тега из разных потоков или процессов дает один и тот же id.
+    В словарь новые теги попадают только после коммита, чтобы в нем не оказалось id из откаченной транзакции
+    """
+
+    def __init__(self):
+        self.ids: Optional[Dict[str, int]] = None
+        self.lock: threading.Lock = threading.Lock()
+
+    def load(self, session: Any = None) -> Dict[str, int]:
+        """
+        Загрузка всех тегов из БД (если словарь еще не загружен)
+        """
+        with self.lock:
+            if self.ids is not None:
+                return self.ids
+
+            own_session = session is None
+            if own_session:
+                session = SessionLocal()
+            self.ids = {tag_name: tag_id for tag_id, tag_name in session.query(Tag.id, Tag.tag_name)}
+            if own_session:
+                session.close()
+            return self.ids
+
+    def get(self, tag: str, session: Any = None) -> Optional[int]:
+        """
+        id тега (None, если такого тега пока нет)
+        """
+        return self.load(session).get(tag)
+
+    def publish(self, tags: Dict[str, int]) -> None:
+        """
+        Добавление в словарь тегов, которые уже точно есть в БД
+        """
+        if self.ids is None:
+            return
+        with self.lock:
+            self.ids.update(tags)
+
+    def resolve(self, tags: Iterable[str], session: Any) -> Dict[str, int]:
+        """
+        id тегов по названиям; недостающие теги создаются в рамках сессии session
+
+        Если все теги уже известны, к БД не обращаемся
+        """
+        ids = self.load(session)
+        tags = set(tags)
+        tag_ids = {tag: ids[tag] for tag in tags if tag in ids}
+        missing = [tag for tag in tags if tag not in tag_ids]
+        if not missing:
+            return tag_ids
+
+        session.execute(insert(Tag).prefix_with('OR IGNORE'), [{'tag_name': tag} for tag in missing])
+        new_ids = {tag_name: tag_id for tag_id, tag_name
+                   in session.execute(select(Tag.id, Tag.tag_name).where(Tag.tag_name.in_(missing)))}
+        event.listen(session, 'after_commit', lambda _: self.publish(new_ids), once=True)
+
+        tag_ids.update(new_ids)
+        return tag_ids
+
+    def clear(self) -> None:
+        """
+        Очистка словаря (загрузится заново при следующем обращении)
+        """
+        with self.lock:
+            self.ids = None
+
+
+# Экземпляр словаря на весь процесс
+tag_vocabulary = TagVocabulary()
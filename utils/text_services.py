@@ -1,39 +1,208 @@
 from string import punctuation
-from nltk.tokenize import word_tokenize
-from pymorphy2 import MorphAnalyzer
-from nltk.corpus import stopwords
-from sklearn.feature_extraction.text import TfidfVectorizer
+import atexit
+import json
+import multiprocessing
+import re
+import threading
 import numpy as np
-from typing import List, Any, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from core import (
+    PREPROCESS_WORKERS,
+    PREPROCESS_CHUNK,
+    LEMMA_CACHE_SIZE,
+    LEMMA_CACHE_FILE
+)
+from typing import List, Any, Tuple, Optional, Dict, Set
 
-# Экземпляр класса MorphAnalyzer
-morph = MorphAnalyzer()
-# Стоп-слова
-stop_words = set(stopwords.words('russian'))
+# pymorphy2, nltk и sklearn импортируются при первом использовании: импорт одного nltk занимает секунды,
+# а для первого ответа бота они не нужны
+
+# Экземпляр класса MorphAnalyzer (создается при первом использовании, в каждом процессе свой)
+morph = None
+# MorphAnalyzer и кэш лемм общие для всех потоков бота, поэтому создание анализатора,
+# разбор слов и изменение кэша идут под блокировкой (попадание в кэш - без нее)
+morph_lock = threading.RLock()
+# Стоп-слова (загружаются при первом использовании)
+stop_words = None
+# Кэш лемм: токен -> лемма
+lemma_cache: Dict[str, str] = {}
+lemma_cache_loaded = False
+
+# Символы, которые nltk.word_tokenize всегда выделяет в отдельные токены
+SPLIT_CHARS = '«“‘„»”’\u2012-\u2015;@#$%&?!*()\\[\\]{}<>"`'
+# Символ слова: все, кроме пробелов, отделяемых символов и знаков, которые внутри слова допустимы только между буквами
+WORD_CHAR = f"[^\\s{SPLIT_CHARS}:,.'\\-]"
+# Сокращение из букв с точками ("т.е.", "в.", "А.С."): punkt не считает такую точку концом предложения,
+# и nltk оставляет ее в токене - кроме многоточия и точки в самом конце текста, которые он отделяет
+ABBREVIATION = f"(?:[^\\W\\d_]\\.)+(?!{WORD_CHAR}|\\.)(?![\\s\\]\\)}}>\"']*$)"
+# Токен как у nltk.word_tokenize: сокращение, слово (с дефисами, точками, апострофами и "3,5" внутри) или отдельный
+# кавычка/тире. Знаки ascii-пунктуации, которые nltk выделяет отдельно, не нужны - после strip от них ничего не остается
+TOKEN_PATTERN = re.compile(
+    f"{ABBREVIATION}|(?:(?<!-)-)?{WORD_CHAR}+(?:(?:[.']|-(?!-)|[:,](?=\\d)){WORD_CHAR}+)*(?:-(?!-))?"
+    f"|[«“‘„»”’\u2012-\u2015]")
+
+
+def get_morph() -> Any:
+    """
+    Экземпляр MorphAnalyzer для текущего процесса
+    """
+    global morph
+    if morph is None:
+        with morph_lock:
+            if morph is None:
+                from pymorphy2 import MorphAnalyzer
+                morph = MorphAnalyzer()
+    return morph
+
+
+def get_stop_words() -> Set[str]:
+    """
+    Русские стоп-слова из nltk
+    """
+    global stop_words
+    if stop_words is None:
+        with morph_lock:
+            if stop_words is None:
+                from nltk.corpus import stopwords
+                stop_words = set(stopwords.words('russian'))
+    return stop_words
+
+
+def tokenize(message: str) -> List[str]:
+    """
+    Быстрая токенизация регуляркой (для наших текстов дает те же токены, что и nltk.word_tokenize)
+    """
+    return TOKEN_PATTERN.findall(message)
+
+
+def load_lemma_cache() -> None:
+    """
+    Загрузка кэша лемм из LEMMA_CACHE_FILE (если он задан и существует)
+    """
+    global lemma_cache_loaded
+    with morph_lock:
+        if lemma_cache_loaded:
+            return
+        lemma_cache_loaded = True
+        try:
+            with open(LEMMA_CACHE_FILE, 'r', encoding='utf-8') as cache_file:
+                lemma_cache.update(json.load(cache_file))
+        except (TypeError, FileNotFoundError, ValueError):
+            pass
+
+
+def save_lemma_cache() -> None:
+    """
+    Сохранение кэша лемм в LEMMA_CACHE_FILE (если он задан)
+    """
+    if LEMMA_CACHE_FILE and lemma_cache:
+        with morph_lock, open(LEMMA_CACHE_FILE, 'w', encoding='utf-8') as cache_file:
+            json.dump(lemma_cache, cache_file, ensure_ascii=False)
+
+
+def lemmatize(token: str) -> str:
+    """
+    Лемма токена (с кэшем - в тостах одни и те же слова повторяются постоянно)
+    """
+    lemma = lemma_cache.get(token)
+    if lemma is None:
+        if not lemma_cache_loaded and LEMMA_CACHE_FILE:
+            load_lemma_cache()
+            return lemmatize(token)
+
+        with morph_lock:
+            lemma = get_morph().parse(token)[0].normal_form.replace('h', 'н')
+            # Кэш переполнен - выкидываем самый старый токен
+            if len(lemma_cache) >= LEMMA_CACHE_SIZE:
+                del lemma_cache[next(iter(lemma_cache))]
+            lemma_cache[token] = lemma
+    return lemma
 
 
 def preprocess_text(message: str) -> List[str]:
     """
     Преобразование текста в список лемм
     """
-    return [morph.parse(token.strip(punctuation + '–'))[0].normal_form.replace('h', 'н')
-            for token in word_tokenize(message)
+    stop_words = get_stop_words()
+    return [lemmatize(token.strip(punctuation + '–'))
+            for token in tokenize(message)
             if token.strip(punctuation + '–') and token not in stop_words and not token.isdigit()]
 
 
+# Сохраняем кэш лемм при остановке
+atexit.register(save_lemma_cache)
+
+
+def preprocess_chunk(messages: List[str]) -> List[List[str]]:
+    """
+    Препроцессинг пачки текстов (выполняется в процессе из пула)
+    """
+    return [preprocess_text(message) for message in messages]
+
+
+def preprocess_many(messages: List[str], workers: Optional[int] = None) -> List[List[str]]:
+    """
+    Препроцессинг множества текстов на всех ядрах. Леммы возвращаются в порядке текстов
+
+    workers - число процессов (по умолчанию PREPROCESS_WORKERS)
+    """
+    workers = workers or PREPROCESS_WORKERS
+    chunks = [messages[i:i + PREPROCESS_CHUNK] for i in range(0, len(messages), PREPROCESS_CHUNK)]
+
+    # Мало данных - не стоит поднимать процессы
+    if workers == 1 or len(chunks) < 2:
+        return preprocess_chunk(messages)
+
+    # Каждый процесс один раз создает свой MorphAnalyzer. spawn, а не fork: вызывать могут и из потоков бота
+    # (tf-idf в фоне, дочитывание индекса), и при fork процесс унаследовал бы занятый другим потоком morph_lock
+    with ProcessPoolExecutor(max_workers=workers, initializer=get_morph,
+                             mp_context=multiprocessing.get_context('spawn')) as pool:
+        return [lemmas for chunk in pool.map(preprocess_chunk, chunks) for lemmas in chunk]
+
+
 def get_top_tf_idf_words(tfidf_vector: Any, feature_names: Any, top_n: int) -> Any:
     """
-    Получение n самых важных слов по tf-idf
+    Получение n самых важных слов по tf-idf (при равном весе - в порядке словаря)
     """
-    sorted_nzs = np.argsort(tfidf_vector.data)[:-(top_n+1):-1]
+    sorted_nzs = np.argsort(-tfidf_vector.data, kind='stable')[:top_n]
     return feature_names[tfidf_vector.indices[sorted_nzs]]
 
 
+def get_top_tf_idf_batch(tfidf_matrix: Any, feature_names: Any, top_n: int) -> List[List[str]]:
+    """
+    Получение n самых важных слов по tf-idf сразу для всех строк матрицы (в том же порядке, что get_top_tf_idf_words)
+    """
+    tfidf_matrix = tfidf_matrix.tocsr()
+    row_sizes = np.diff(tfidf_matrix.indptr)
+    rows = np.repeat(np.arange(tfidf_matrix.shape[0]), row_sizes)
+
+    # Сортируем все ненулевые элементы по строке, а внутри строки - по убыванию веса. lexsort устойчивая:
+    # при равном весе слова остаются в порядке индексов строки, т.е. словаря (как в get_top_tf_idf_words).
+    # После сортировки строка i занимает те же позиции indptr[i]:indptr[i + 1], что и до нее
+    tfidf_matrix.sort_indices()
+    order = np.lexsort((-tfidf_matrix.data, rows))
+    rank = np.arange(len(order)) - tfidf_matrix.indptr[rows]
+    top = tfidf_matrix.indices[order[rank < top_n]]
+
+    # Режем общий список на строки: в каждой min(число ненулевых, top_n) слов
+    words = feature_names[top].tolist()
+    bounds = np.concatenate(([0], np.cumsum(np.minimum(row_sizes, top_n)))).tolist()
+    return [words[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def make_tfidf(vocabulary: Optional[Dict[str, int]] = None) -> Any:
+    """
+    Экземпляр tf-idf с нашими настройками (vocabulary - готовый словарь, если модель загружается из артефакта)
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    return TfidfVectorizer(stop_words=list(get_stop_words()), max_features=10000, vocabulary=vocabulary)
+
+
 def create_tfidf(text_array: List[str]) -> Tuple[Any, Any]:
     """
     Создание экземпляра tf-idf и получение feature names
     """
-    tfidf = TfidfVectorizer(stop_words=list(stop_words), max_features=10000)
+    tfidf = make_tfidf()
     texts_tfidf = tfidf.fit_transform(text_array)
     feature_names = np.array(tfidf.get_feature_names_out())
     return texts_tfidf, feature_names
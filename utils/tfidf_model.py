@@ -0,0 +1,100 @@
+import logging
+import threading
+import numpy as np
+from sqlalchemy.sql import func
+from .artifacts import artifact_path, artifact_version, find_artifact, write_artifact
+from .database import SessionLocal
+from .models import Toast
+from .text_services import (
+    make_tfidf,
+    preprocess_many,
+    get_top_tf_idf_words
+)
+from typing import Any, List, Optional
+
+
+class TfidfModel:
+    """
+    Tf-idf по всему корпусу: обучается один раз при заливке, хранится артефактом
+    (словарь + массив idf) и при старте бота только загружается
+
+    Новые тосты векторизуются через transform обученной модели, словарь не меняется до следующей заливки
+    """
+
+    def __init__(self):
+        self.vectorizer: Any = None
+        self.feature_names: Any = None
+        # Версия корпуса, на котором обучена модель (0 - модель еще не загружена)
+        self.version: int = 0
+        self.lock: threading.Lock = threading.Lock()
+
+    def set(self, feature_names: Any, idf: Any) -> None:
+        """
+        Сборка векторайзера из словаря и idf
+        """
+        self.vectorizer = make_tfidf({feature_name: i for i, feature_name in enumerate(feature_names)})
+        self.vectorizer.idf_ = idf
+        self.feature_names = np.asarray(feature_names)
+
+    def fit(self, texts_preprocessed: Optional[List[str]] = None) -> Any:
+        """
+        Обучение на всем корпусе и сохранение артефакта. Возвращает матрицу tf-idf текстов
+
+        texts_preprocessed - леммы тостов через пробел (если не переданы - берем все тосты из БД)
+        """
+        session = SessionLocal()
+        corpus_version = session.query(func.max(Toast.id)).scalar() or 0
+        if texts_preprocessed is None:
+            texts = [row[0] for row in session.query(Toast.toast_text).order_by(Toast.id)]
+            texts_preprocessed = [" ".join(lemmas) for lemmas in preprocess_many(texts)]
+        session.close()
+
+        logging.info(f"Fitting TfIdf for corpus version {corpus_version}...")
+        vectorizer = make_tfidf()
+        texts_tfidf = vectorizer.fit_transform(texts_preprocessed)
+        self.set(vectorizer.get_feature_names_out(), vectorizer.idf_)
+        self.version = corpus_version
+
+        write_artifact(artifact_path('tfidf', corpus_version, 'npz'), lambda artifact_file: np.savez(
+            artifact_file, feature_names=self.feature_names.astype(str), idf=vectorizer.idf_), binary=True)
+        return texts_tfidf
+
+    def load(self) -> None:
+        """
+        Загрузка модели из артефакта, а если его нет - обучение по корпусу из БД
+        """
+        path = find_artifact('tfidf', 'npz')
+        if path is None:
+            self.fit()
+            return
+
+        logging.info(f"Loading TfIdf from {path}")
+        with np.load(path) as artifact:
+            self.set(artifact['feature_names'], artifact['idf'])
+        self.version = artifact_version(path)
+
+    def ensure(self) -> None:
+        """
+        Загрузка модели, если она еще не загружена
+        """
+        if self.vectorizer is None:
+            with self.lock:
+                if self.vectorizer is None:
+                    self.load()
+
+    def transform(self, texts_preprocessed: List[str]) -> Any:
+        """
+        Матрица tf-idf для новых текстов (лемм через пробел)
+        """
+        self.ensure()
+        return self.vectorizer.transform(texts_preprocessed)
+
+    def top_words(self, text_preprocessed: str, top_n: int) -> List[str]:
+        """
+        top_n самых важных по tf-idf слов текста
+        """
+        return get_top_tf_idf_words(self.transform([text_preprocessed])[0, :], self.feature_names, top_n).tolist()
+
+
+# Экземпляр модели на весь процесс
+tfidf_model = TfidfModel()